@@ -0,0 +1,132 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from database import Database, READER_POOL_SIZE
+from metrics import Histogram
+
+
+class AsyncDatabase:
+    """Database 的异步封装
+
+    所有查询都在工作线程池中执行，服务器的事件循环只负责 await 结果，
+    慢查询不会阻塞其他用户的消息收发。读操作使用 Database 的只读连接池并发执行，
+    写操作由 Database 串行化到唯一的写连接上。
+    """
+
+    def __init__(self, db_path=None, readers=READER_POOL_SIZE):
+        self.db = Database(db_path, readers)
+        # 每个只读连接一个线程，再加一个线程留给写操作
+        self._executor = ThreadPoolExecutor(max_workers=readers + 1, thread_name_prefix='db')
+        self.latency = {}  # 方法名 -> 耗时直方图，包括在线程池中排队的时间
+
+    async def _run(self, func, *args):
+        """在数据库线程中执行同步方法"""
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            name = getattr(func, '__name__', 'unknown')
+            histogram = self.latency.get(name)
+            if histogram is None:
+                histogram = self.latency[name] = Histogram(name)
+            histogram.observe(time.perf_counter() - start)
+
+    async def get_credentials(self, username):
+        """获取用户信息和保存的密码，密码校验由 PasswordHasher 在进程池中完成"""
+        return await self._run(self.db.get_credentials, username)
+
+    async def update_password_hash(self, user_id, old_password, password_hash):
+        """把密码替换为新的哈希"""
+        return await self._run(self.db.update_password_hash, user_id, old_password, password_hash)
+
+    async def add_user(self, username, password_hash, nickname, avatar_path):
+        """注册新用户，密码需要先用 PasswordHasher 计算哈希"""
+        return await self._run(self.db.add_user, username, password_hash, nickname, avatar_path, True)
+
+    async def get_user_by_id(self, user_id):
+        """通过ID获取用户信息"""
+        return await self._run(self.db.get_user_by_id, user_id)
+
+    async def get_user_by_username(self, username):
+        """通过用户名获取用户信息"""
+        return await self._run(self.db.get_user_by_username, username)
+
+    async def get_user_by_nickname(self, nickname):
+        """通过昵称获取用户信息"""
+        return await self._run(self.db.get_user_by_nickname, nickname)
+
+    async def get_friends(self, user_id):
+        """获取用户的好友列表"""
+        return await self._run(self.db.get_friends, user_id)
+
+    async def add_friend(self, user_id, friend_id):
+        """添加好友关系"""
+        return await self._run(self.db.add_friend, user_id, friend_id)
+
+    async def add_friend_request(self, user_id, friend_username):
+        """发送好友请求"""
+        return await self._run(self.db.add_friend_request, user_id, friend_username)
+
+    async def save_message(self, sender_id, receiver_id, content, message_type='text'):
+        """保存聊天消息"""
+        return await self._run(self.db.save_message, sender_id, receiver_id, content, message_type)
+
+    async def save_messages(self, messages, delivered_ids=()):
+        """在一个事务中批量保存聊天消息，并标记已送达的消息"""
+        return await self._run(self.db.save_messages, messages, delivered_ids)
+
+    async def get_undelivered(self, user_id, after_id=0, limit=500):
+        """获取发给用户且尚未送达的消息"""
+        return await self._run(self.db.get_undelivered, user_id, after_id, limit)
+
+    async def create_group(self, name, owner_id):
+        """创建群聊"""
+        return await self._run(self.db.create_group, name, owner_id)
+
+    async def add_group_member(self, group_id, user_id):
+        """加入群聊"""
+        return await self._run(self.db.add_group_member, group_id, user_id)
+
+    async def remove_group_member(self, group_id, user_id):
+        """退出群聊"""
+        return await self._run(self.db.remove_group_member, group_id, user_id)
+
+    async def get_group(self, group_id):
+        """获取群聊信息"""
+        return await self._run(self.db.get_group, group_id)
+
+    async def get_group_members(self, group_id):
+        """获取群成员"""
+        return await self._run(self.db.get_group_members, group_id)
+
+    async def get_user_groups(self, user_id):
+        """获取用户加入的群聊"""
+        return await self._run(self.db.get_user_groups, user_id)
+
+    async def iter_history(self, user_id, friend_id, before_id=None, limit=50, chunk_size=20):
+        """逐块读取一页聊天记录，每块都在数据库线程中读取，参见 Database.iter_history"""
+        async for chunk in self._iter_chunks(self.db.iter_history(user_id, friend_id, before_id, limit, chunk_size)):
+            yield chunk
+
+    async def iter_group_history(self, group_id, user_id, before_id=None, limit=50, chunk_size=20):
+        """逐块读取一页群聊记录，参见 Database.iter_group_history"""
+        async for chunk in self._iter_chunks(self.db.iter_group_history(group_id, user_id, before_id, limit, chunk_size)):
+            yield chunk
+
+    async def _iter_chunks(self, chunks):
+        """在数据库线程中逐块推进生成器"""
+        try:
+            while True:
+                chunk = await self._run(next, chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            # 提前结束时关闭生成器，把只读连接还给连接池
+            await self._run(chunks.close)
+
+    def close(self):
+        """关闭工作线程和数据库连接"""
+        self._executor.shutdown(wait=True)
+        self.db.close()
@@ -0,0 +1,63 @@
+"""比较各编解码器在典型帧上的编码、解码速度和帧大小
+
+用法: python bench_codec.py [次数]
+"""
+import sys
+import timeit
+from codec import CODECS
+
+
+def sample_payloads():
+    """构造与服务器实际发送的帧结构相同的样例"""
+    message = {
+        'type': 'message',
+        'message_id': 123456,
+        'from_id': 1,
+        'from_nickname': '张三',
+        'content': '晚上一起吃饭吗？我知道一家新开的店，味道不错。',
+        'message_type': 'text',
+        'timestamp': '2024-01-01 12:00:00'
+    }
+    history = {
+        'type': 'history_chunk',
+        'id': 42,
+        'friend_nickname': '李四',
+        'before_id': None,
+        'seq': 0,
+        'messages': [{
+            'message_id': 1000 + i,
+            'content': f'第 {i} 条消息，内容长度和平时聊天差不多。',
+            'type': 'text',
+            'timestamp': '2024-01-01 12:00:00',
+            'is_send': i % 2 == 0,
+            'sender_nickname': '张三' if i % 2 == 0 else '李四',
+            'receiver_nickname': '李四' if i % 2 == 0 else '张三'
+        } for i in range(20)]
+    }
+    friends = {
+        'type': 'friends_list',
+        'friends': [{
+            'user_id': i,
+            'username': f'user{i}',
+            'nickname': f'好友{i}',
+            'avatar_path': f'data/avatars/{i}.png'
+        } for i in range(100)]
+    }
+    return {'message': message, 'history': history, 'friends': friends}
+
+
+def bench(number):
+    payloads = sample_payloads()
+    print(f"{'编码':<10}{'帧':<10}{'大小(字节)':>12}{'编码(次/秒)':>14}{'解码(次/秒)':>14}")
+    for name, obj in payloads.items():
+        for codec in CODECS:
+            data = codec.encode(obj)
+            size = len(data.encode() if isinstance(data, str) else data)
+            encode_time = timeit.timeit(lambda: codec.encode(obj), number=number)
+            decode_time = timeit.timeit(lambda: codec.decode(data), number=number)
+            print(f"{codec.name:<10}{name:<10}{size:>12}{number / encode_time:>14.0f}{number / decode_time:>14.0f}")
+        print()
+
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,272 @@
+import asyncio
+import itertools
+import json
+import os
+import signal
+import tempfile
+from log import get_logger, setup_logging, shutdown_logging
+
+BROKER_PATH = os.path.join(tempfile.gettempdir(), 'sapphirekey-broker.sock')  # 默认的 Unix socket 路径
+BROKER_CONNECT_RETRIES = 50  # 工作进程连接中转进程的重试次数，每次间隔 0.1 秒
+BROKER_LINE_LIMIT = 16 * 1024 * 1024  # 单条消息的长度上限
+BROKER_ACK_TIMEOUT = 5  # 等待中转进程确认上线的时间（秒）
+
+log = get_logger('broker')
+
+# 进程间消息是一行 JSON，op 字段表示类型：
+#   hello     工作进程连上后报告 worker_id
+#   online    用户在该工作进程上的第一个连接登录，中转进程回复 ack
+#   offline   用户在该工作进程上的最后一个连接断开
+#   deliver   把帧转发给用户所在的其他工作进程
+#   fanout    把帧转发给一组用户所在的其他工作进程，每个进程只收到一条
+#   broadcast 把事件转发给其他所有工作进程（缓存失效等）
+#   presence  中转进程发出：用户在所有工作进程中上线或全部下线
+
+
+class Broker:
+    """工作进程之间的中转进程
+
+    维护用户所在的工作进程表，按表转发发给其他工作进程上用户的帧，
+    并在用户第一次上线、最后一个连接下线时向所有工作进程广播在线状态。
+    """
+
+    def __init__(self):
+        self._workers = {}  # worker_id -> StreamWriter
+        self._locations = {}  # user_id -> 用户有连接的 worker_id 集合
+
+        # 统计信息
+        self.routed = 0
+        self.dropped = 0
+        self.broadcasts = 0
+
+    def _send(self, worker_id, message):
+        writer = self._workers.get(worker_id)
+        if writer is not None and not writer.is_closing():
+            writer.write(json.dumps(message).encode() + b'\n')
+
+    def _publish_presence(self, user_id, status):
+        for worker_id in self._workers:
+            self._send(worker_id, {'op': 'presence', 'user_id': user_id, 'status': status})
+
+    def _online(self, worker_id, user_id):
+        locations = self._locations.setdefault(user_id, set())
+        locations.add(worker_id)
+        if len(locations) == 1:
+            self._publish_presence(user_id, 'online')
+
+    def _offline(self, worker_id, user_id):
+        locations = self._locations.get(user_id)
+        if not locations:
+            return
+        locations.discard(worker_id)
+        if not locations:
+            del self._locations[user_id]
+            self._publish_presence(user_id, 'offline')
+
+    async def handle_worker(self, reader, writer):
+        worker_id = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                op = message['op']
+                if op == 'hello':
+                    worker_id = message['worker_id']
+                    self._workers[worker_id] = writer
+                    log.info("工作进程已连接中转进程", worker_id=worker_id)
+                elif op == 'online':
+                    self._online(worker_id, message['user_id'])
+                    self._send(worker_id, {'op': 'ack', 'seq': message['seq']})
+                elif op == 'offline':
+                    self._offline(worker_id, message['user_id'])
+                elif op == 'deliver':
+                    targets = self._locations.get(message['user_id'], ())
+                    routed = False
+                    for target in targets:
+                        if target != worker_id:
+                            self._send(target, message)
+                            routed = True
+                    if routed:
+                        self.routed += 1
+                    else:
+                        self.dropped += 1
+                elif op == 'fanout':
+                    # 按工作进程分组，每个进程只转发一次
+                    by_worker = {}
+                    for user_id in message['user_ids']:
+                        for target in self._locations.get(user_id, ()):
+                            if target != worker_id:
+                                by_worker.setdefault(target, []).append(user_id)
+                    for target, user_ids in by_worker.items():
+                        self._send(target, {'op': 'fanout', 'user_ids': user_ids, 'frame': message['frame']})
+                    self.routed += len(by_worker)
+                elif op == 'broadcast':
+                    self.broadcasts += 1
+                    for target in self._workers:
+                        if target != worker_id:
+                            self._send(target, message)
+                await writer.drain()
+        except asyncio.CancelledError:
+            # 中转进程退出时正常结束，Python 3.11 的 start_unix_server 回调对被取消的任务会打印 CancelledError
+            pass
+        except Exception as e:
+            log.error("中转进程处理工作进程失败", worker_id=worker_id, error=str(e))
+        finally:
+            if worker_id is not None and self._workers.get(worker_id) is writer:
+                # 工作进程退出，它上面的用户全部下线
+                del self._workers[worker_id]
+                for user_id in [u for u, workers in self._locations.items() if worker_id in workers]:
+                    self._offline(worker_id, user_id)
+                log.info("工作进程已断开中转进程", worker_id=worker_id)
+            writer.close()
+
+    def stats(self):
+        """返回中转进程的统计信息"""
+        return {
+            'workers': len(self._workers),
+            'users': len(self._locations),
+            'routed': self.routed,
+            'dropped': self.dropped,
+            'broadcasts': self.broadcasts,
+        }
+
+
+async def serve_broker(path=BROKER_PATH):
+    """运行中转进程直到被取消"""
+    if os.path.exists(path):
+        os.unlink(path)
+    broker = Broker()
+    server = await asyncio.start_unix_server(broker.handle_worker, path, limit=BROKER_LINE_LIMIT)
+    log.info("中转进程已启动", path=path)
+    try:
+        async with server:
+            # 多进程模式下父进程用 SIGTERM 通知中转进程退出
+            stop = asyncio.Event()
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+            await stop.wait()
+    finally:
+        log.info("中转统计", **broker.stats())
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def run_broker(path=BROKER_PATH):
+    """中转进程入口"""
+    # 由父进程统一用 SIGTERM 通知退出，fork 继承来的父进程处理函数先恢复默认
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    setup_logging()
+    try:
+        asyncio.run(serve_broker(path))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutdown_logging()
+
+
+class BrokerClient:
+    """工作进程到中转进程的连接
+
+    on_event(message) 处理中转进程发来的 presence、deliver 和 broadcast 消息。
+    """
+
+    def __init__(self, worker_id, on_event, path=BROKER_PATH):
+        self.worker_id = worker_id
+        self.on_event = on_event
+        self.path = path
+        self._reader = None
+        self._writer = None
+        self._task = None
+        self._seq = itertools.count(1)
+        self._acks = {}  # seq -> 等待 ack 的 Future
+
+    async def connect(self):
+        """连接中转进程，中转进程可能还没启动完成，失败时重试"""
+        for _ in range(BROKER_CONNECT_RETRIES):
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(self.path, limit=BROKER_LINE_LIMIT)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.1)
+        else:
+            raise ConnectionError(f"无法连接中转进程: {self.path}")
+        self._send({'op': 'hello', 'worker_id': self.worker_id})
+        self._task = asyncio.create_task(self._read_loop())
+
+    def _send(self, message):
+        self._writer.write(json.dumps(message).encode() + b'\n')
+
+    async def _read_loop(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if message['op'] == 'ack':
+                    future = self._acks.pop(message['seq'], None)
+                    if future and not future.done():
+                        future.set_result(None)
+                    continue
+                try:
+                    self.on_event(message)
+                except Exception as e:
+                    log.error("处理中转消息失败", op=message.get('op'), error=str(e))
+        finally:
+            log.info("与中转进程的连接已断开", worker_id=self.worker_id)
+            for future in self._acks.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("中转进程连接已断开"))
+            self._acks.clear()
+
+    @property
+    def connected(self):
+        """与中转进程的连接是否还在，断开后读任务结束"""
+        return self._task is not None and not self._task.done()
+
+    async def user_online(self, user_id):
+        """报告用户在本进程上线，中转进程登记后返回
+
+        返回后发往该用户的帧一定会转发到本进程，此时再查询离线消息不会漏掉消息。
+        连接已断开或超时未收到确认时抛出 ConnectionError。
+        """
+        if not self.connected:
+            raise ConnectionError("中转进程连接已断开")
+        seq = next(self._seq)
+        future = asyncio.get_running_loop().create_future()
+        self._acks[seq] = future
+        self._send({'op': 'online', 'user_id': user_id, 'seq': seq})
+        try:
+            await asyncio.wait_for(future, BROKER_ACK_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise ConnectionError("等待中转进程确认超时") from None
+        finally:
+            self._acks.pop(seq, None)
+
+    def user_offline(self, user_id):
+        """报告用户在本进程的最后一个连接断开"""
+        self._send({'op': 'offline', 'user_id': user_id})
+
+    def deliver(self, user_id, frame, message_id=None):
+        """把帧转发给用户在其他工作进程上的连接"""
+        self._send({'op': 'deliver', 'user_id': user_id, 'frame': frame, 'message_id': message_id})
+
+    def fanout(self, user_ids, frame):
+        """把帧转发给这些用户在其他工作进程上的连接"""
+        self._send({'op': 'fanout', 'user_ids': user_ids, 'frame': frame})
+
+    def broadcast(self, event, **fields):
+        """把事件广播给其他所有工作进程"""
+        self._send({'op': 'broadcast', 'event': event, **fields})
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
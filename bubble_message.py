@@ -270,11 +270,15 @@ class ScrollBar(QScrollBar):
 class ChatWidget(QWidget):
     # 添加消息发送信号
     message_sent = pyqtSignal(str)  # 发送消息内容
+    load_more_requested = pyqtSignal()  # 滚动到顶部，请求更早的聊天记录
     
     def __init__(self, parent=None):
         super().__init__(parent)
         self.send_avatar = None
         self.receive_avatar = None
+        self.has_more_history = False  # 是否还有更早的聊天记录
+        self.loading_history = False  # 是否正在加载更早的聊天记录
+        self._scroll_anchor = None  # 插入旧消息前距离底部的距离
         self.init_ui()
         
     def set_avatars(self, send_avatar, receive_avatar):
@@ -294,6 +298,8 @@ class ChatWidget(QWidget):
         self.scrollArea = ScrollArea(self)
         scrollBar = ScrollBar()
         self.scrollArea.setVerticalScrollBar(scrollBar)
+        scrollBar.valueChanged.connect(self.on_scroll_value_changed)
+        scrollBar.rangeChanged.connect(self.on_scroll_range_changed)
         self.scrollAreaWidgetContents = ScrollAreaContent(self.scrollArea)
         self.scrollAreaWidgetContents.setMinimumSize(50, 100)
         self.scrollArea.setWidget(self.scrollAreaWidgetContents)
@@ -392,6 +398,20 @@ class ChatWidget(QWidget):
         except Exception as e:
             print(f"滚动到底部失败: {e}")
 
+    def on_scroll_value_changed(self, value):
+        """滚动到顶部时请求更早的聊天记录"""
+        scrollbar = self.verticalScrollBar()
+        if value == scrollbar.minimum() and scrollbar.maximum() > 0 \
+                and self.has_more_history and not self.loading_history:
+            self.loading_history = True
+            self.load_more_requested.emit()
+
+    def on_scroll_range_changed(self, minimum, maximum):
+        """在顶部插入旧消息后保持当前可见的位置不变"""
+        if self._scroll_anchor is not None:
+            self.verticalScrollBar().setValue(maximum - self._scroll_anchor)
+            self._scroll_anchor = None
+
     def set_scroll_bar_value(self, val):
         self.verticalScrollBar().setValue(val)
 
@@ -409,6 +429,10 @@ class ChatWidget(QWidget):
     def clear_messages(self):
         """清空所有消息"""
         try:
+            self.has_more_history = False
+            self.loading_history = False
+            if hasattr(self, 'last_message_date'):
+                del self.last_message_date
             # 清空布局中的所有消息
             while self.layout0.count():
                 item = self.layout0.takeAt(0)
@@ -443,6 +467,49 @@ class ChatWidget(QWidget):
             print(f"加载聊天记录失败: {e}")
             raise
 
+    def prepend_messages(self, messages):
+        """在顶部插入一块更早的聊天记录
+
+        messages 按时间正序排列，每项为 (content, is_send, avatar_path, message_type, timestamp)。
+        """
+        try:
+            scrollbar = self.verticalScrollBar()
+            self._scroll_anchor = scrollbar.maximum() - scrollbar.value()
+            
+            # 第一次插入时记录最新消息的日期，后续实时消息据此决定是否添加日期分割线
+            if messages and messages[-1][4] and not hasattr(self, 'last_message_date'):
+                self.last_message_date = messages[-1][4].split()[0]
+            
+            position = 0
+            current_date = None
+            for content, is_send, avatar_path, message_type, timestamp in messages:
+                # 添加日期分割线
+                if timestamp:
+                    message_date = timestamp.split()[0]
+                    if current_date != message_date:
+                        current_date = message_date
+                        self.layout0.insertWidget(position, Notice(timestamp))
+                        position += 1
+                
+                bubble = BubbleMessage(
+                    content,
+                    avatar_path,
+                    MessageType.Text if message_type == 'text' else MessageType.Image,
+                    is_send,
+                    timestamp
+                )
+                self.layout0.insertWidget(position, bubble)
+                position += 1
+            
+            # 原来最上方的日期分割线与插入的最后一条消息同一天时，去掉重复的分割线
+            item = self.layout0.itemAt(position)
+            widget = item.widget() if item else None
+            if isinstance(widget, Notice) and current_date and widget.text().split()[0] == current_date:
+                self.layout0.takeAt(position)
+                widget.deleteLater()
+        except Exception as e:
+            print(f"插入历史消息失败: {e}")
+
     def add_message(self, content, is_send, avatar_path, message_type='text', timestamp=None):
         """添加一条消息"""
         try:
@@ -1,12 +1,29 @@
 import asyncio
+import itertools
+from collections import deque
 import websockets
 import json
+from codec import JSON, SUBPROTOCOLS, codec_for
+from compression import CompressionPolicy
 from PyQt5.QtCore import QObject, pyqtSignal
 from database import Database
+from log import get_logger
+
+REQUEST_TIMEOUT = 10  # 请求等待响应的默认超时时间（秒）
+SEEN_MESSAGE_LIMIT = 1000  # 用于去重的最近 message_id 数量
+
+log = get_logger('chat_client')
+
+# 这些响应帧表示对应 id 的请求已经完成
+FINAL_RESPONSE_TYPES = ('auth', 'friends_list', 'history', 'history_end', 'message_ack', 'batch_result',
+                        'group_created', 'group_joined', 'group_left', 'groups_list')
+
 
 class ChatClient(QObject):
     message_received = pyqtSignal(int, str, str, str)
-    history_received = pyqtSignal(list)
+    message_sent = pyqtSignal(int, str, str, str)  # 本账号在其他设备上发出的消息: to_id, to_nickname, content, message_type
+    group_message_received = pyqtSignal(int, int, str, str, str)  # group_id, from_id, from_nickname, content, message_type
+    history_received = pyqtSignal(list, dict)  # 聊天记录, 分页信息
     online_status_changed = pyqtSignal(int, str)
     friends_list_received = pyqtSignal(list)
     connection_error = pyqtSignal(str)
@@ -17,21 +34,29 @@ class ChatClient(QObject):
         self._connected = False
         self.server_url = 'ws://8.216.86.153:8795'
         self._user_info = None
-        self._message_lock = asyncio.Lock()
+        self.codec = JSON  # 握手时与服务器协商的编解码器
+        self.compression = CompressionPolicy()  # WebSocket 压缩配置
+        self._request_ids = itertools.count(1)
+        self._pending = {}  # 请求 id -> 等待响应的 Future
+        self._seen_message_ids = set()  # 最近收到的 message_id，用于去重
+        self._seen_order = deque()
         
     async def login(self, username, password):
         """登录验证"""
         try:
-            print("正在连接服务器...")
+            log.info("正在连接服务器", url=self.server_url)
             if self.websocket:
                 await self.websocket.close()
                 
             self.websocket = await websockets.connect(
                 self.server_url,
                 ping_interval=None,
-                max_size=None
+                max_size=None,
+                subprotocols=SUBPROTOCOLS,
+                **self.compression.client_options()
             )
-            print("已连接到服务器，正在发送登录请求...")
+            self.codec = codec_for(self.websocket.subprotocol)
+            log.info("已连接到服务器，正在发送登录请求", codec=self.codec.name)
             
             # 发送登录请求
             login_data = {
@@ -39,13 +64,12 @@ class ChatClient(QObject):
                 'username': username,
                 'password': password
             }
-            print(f"发送登录数据: {login_data}")
-            await self.websocket.send(json.dumps(login_data))
+            await self.websocket.send(self.codec.encode(login_data))
             
             # 接收响应
             response = await self.websocket.recv()
-            result = json.loads(response)
-            print(f"收到登录响应：{result}")
+            result = self.codec.decode(response)
+            log.debug("收到登录响应", success=result.get('success'))
             
             # 处理 auth 类型的响应
             if result.get('type') == 'auth' and result.get('success'):
@@ -53,14 +77,14 @@ class ChatClient(QObject):
                 self._user_info = result.get('user_info')
                 # 启动消息接收循环
                 asyncio.create_task(self._receive_messages())
-                print("登录成功，WebSocket 连接已建立")
+                log.info("登录成功，WebSocket 连接已建立")
                 return self._user_info
                 
-            print("登录失败：响应格式不正确")
+            log.warning("登录失败：响应格式不正确", response_type=result.get('type'))
             return None
             
         except Exception as e:
-            print(f"登录失败: {e}")
+            log.error("登录失败", error=str(e))
             self._connected = False
             if self.websocket:
                 await self.websocket.close()
@@ -70,44 +94,165 @@ class ChatClient(QObject):
     async def _receive_messages(self):
         """接收消息循环"""
         try:
-            print("开始消息接收循环")
+            log.debug("开始消息接收循环")
             while self._connected and self.websocket:
                 try:
-                    async with self._message_lock:
-                        message = await self.websocket.recv()
-                    data = json.loads(message)
-                    print(f"收到服务器消息: {data}")
+                    message = await self.websocket.recv()
+                    data = self.codec.decode(message)
+                    log.debug("收到服务器消息", sample=data.get('type'), frame=data)
+                    
+                    self._handle_frame(data)
                     
-                    if data['type'] == 'message':
-                        self.message_received.emit(
-                            data['from_id'],
-                            data['from_nickname'],
-                            data['content'],
-                            data.get('message_type', 'text')
-                        )
-                    elif data['type'] == 'history':
-                        self.history_received.emit(data['messages'])
-                    elif data['type'] == 'friends_list':
-                        print("收到好友列表数据")
-                        self.friends_list_received.emit(data['friends'])
-                    elif data['type'] == 'online_status':
-                        self.online_status_changed.emit(
-                            data['user_id'],
-                            data['status']
-                        )
+                    # 唤醒等待该响应的请求
+                    request_id = data.get('id')
+                    if request_id is not None and data['type'] in FINAL_RESPONSE_TYPES:
+                        future = self._pending.pop(request_id, None)
+                        if future and not future.done():
+                            future.set_result(data)
                 except websockets.exceptions.ConnectionClosed:
-                    print("WebSocket 连接已关闭")
+                    log.info("WebSocket 连接已关闭")
                     break
                 except Exception as e:
-                    print(f"处理消息错误: {e}")
+                    log.error("处理消息错误", error=str(e))
                     continue
                     
         except Exception as e:
-            print(f"接收消息循环错误: {e}")
+            log.error("接收消息循环错误", error=str(e))
         finally:
-            print("消息接收循环结束")
+            log.debug("消息接收循环结束")
             self._connected = False
             self.websocket = None
+            # 连接断开，正在等待的请求全部失败
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("连接已断开"))
+            self._pending.clear()
+
+    def _handle_frame(self, data):
+        """处理一个服务器推送或响应帧"""
+        if data['type'] == 'message':
+            if not self._is_new_message(data.get('message_id')):
+                return
+            if self._user_info and data['from_id'] == self._user_info['user_id'] and 'to_id' in data:
+                self.message_sent.emit(
+                    data['to_id'],
+                    data['to_nickname'],
+                    data['content'],
+                    data.get('message_type', 'text')
+                )
+            else:
+                self.message_received.emit(
+                    data['from_id'],
+                    data['from_nickname'],
+                    data['content'],
+                    data.get('message_type', 'text')
+                )
+        elif data['type'] == 'group_message':
+            if self._is_new_message(data.get('message_id')):
+                self.group_message_received.emit(
+                    data['group_id'],
+                    data['from_id'],
+                    data['from_nickname'],
+                    data['content'],
+                    data.get('message_type', 'text')
+                )
+        elif data['type'] == 'pending_messages':
+            self._on_pending_messages(data)
+        elif data['type'] in ('history', 'history_chunk', 'history_end'):
+            self.history_received.emit(data.get('messages', []), self._page_info(data))
+        elif data['type'] == 'message_ack':
+            if not data.get('success'):
+                log.warning("消息发送失败", message=data.get('message'))
+        elif data['type'] == 'friends_list':
+            self.friends_list_received.emit(data['friends'])
+        elif data['type'] == 'online_status':
+            self.online_status_changed.emit(
+                data['user_id'],
+                data['status']
+            )
+        elif data['type'] == 'ping':
+            # 回应服务器的心跳，否则空闲超时后连接会被关闭
+            asyncio.create_task(self._send_pong())
+        elif data['type'] == 'batch_result':
+            # 批量请求的响应，逐个处理其中的子响应
+            for frame in data.get('frames', []):
+                self._handle_frame(frame)
+
+    async def _send_pong(self):
+        try:
+            await self.websocket.send(self.codec.encode({'type': 'pong'}))
+        except Exception as e:
+            log.error("发送心跳回应失败", error=str(e))
+
+    async def _request(self, payload, timeout=REQUEST_TIMEOUT):
+        """发送带 id 的请求并等待对应的响应
+
+        响应由 _receive_messages 按 id 分发，多个请求可以同时等待。
+        超时抛出 asyncio.TimeoutError。
+        """
+        request_id = next(self._request_ids)
+        payload['id'] = request_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            await self.websocket.send(self.codec.encode(payload))
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    def _is_new_message(self, message_id):
+        """登录时离线补发和实时推送可能重复，按 message_id 去重"""
+        if message_id is None:
+            return True
+        if message_id in self._seen_message_ids:
+            return False
+        self._seen_message_ids.add(message_id)
+        self._seen_order.append(message_id)
+        if len(self._seen_order) > SEEN_MESSAGE_LIMIT:
+            self._seen_message_ids.discard(self._seen_order.popleft())
+        return True
+
+    def _on_pending_messages(self, data):
+        """处理登录后服务器批量补发的离线消息"""
+        fields = data.get('fields', ['message_id', 'content', 'message_type', 'timestamp'])
+        count = 0
+        for conversation in data.get('conversations', []):
+            for values in conversation['messages']:
+                message = dict(zip(fields, values))
+                if not self._is_new_message(message.get('message_id')):
+                    continue
+                self.message_received.emit(
+                    conversation['from_id'],
+                    conversation['from_nickname'],
+                    message['content'],
+                    message.get('message_type', 'text')
+                )
+                count += 1
+        log.info("收到离线消息", count=count)
+
+    @staticmethod
+    def _page_info(data):
+        """提取聊天记录响应中的分页信息
+
+        一页聊天记录由若干 history_chunk 帧和一个 history_end 帧组成，块之间从新到旧。
+        first 表示这是该页的第一帧，done 表示该页已经发送完毕，
+        success 为 False 表示该页获取失败，此时 next_cursor 没有意义。
+        """
+        if data['type'] == 'history_chunk':
+            first = data.get('seq', 0) == 0
+        elif data['type'] == 'history_end':
+            first = data.get('chunks', 0) == 0
+        else:
+            first = True  # 旧版服务器一次发送整页
+        return {
+            'friend_nickname': data.get('friend_nickname'),
+            'group_id': data.get('group_id'),
+            'before_id': data.get('before_id'),
+            'next_cursor': data.get('next_cursor'),
+            'first': first,
+            'done': data['type'] != 'history_chunk',
+            'success': data.get('success', True)
+        }
 
     async def register(self, username, password, nickname):
         """注册新用户"""
@@ -127,7 +272,7 @@ class ChatClient(QObject):
             return result.get('success'), result.get('message')
             
         except Exception as e:
-            print(f"注册失败: {e}")
+            log.error("注册失败", error=str(e))
             return False, str(e)
 
     async def connect(self, username):
@@ -157,11 +302,11 @@ class ChatClient(QObject):
                 return True
             else:
                 error_msg = auth_data.get('error', '认证失败')
-                print(f"认证失败: {error_msg}")
+                log.warning("认证失败", message=error_msg)
                 return False
                 
         except Exception as e:
-            print(f"连接错误: {e}")
+            log.error("连接错误", error=str(e))
             return False
             
     async def _message_loop(self):
@@ -169,12 +314,10 @@ class ChatClient(QObject):
         try:
             while self._connected:
                 message = await self.websocket.recv()
-                print(f"客户端收到消息: {message}")
                 data = json.loads(message)
                 
-                if data['type'] == 'history':
-                    print(f"收到聊天记录: {data['messages']}")
-                    self.history_received.emit(data['messages'])
+                if data['type'] in ('history', 'history_chunk', 'history_end'):
+                    self.history_received.emit(data.get('messages', []), self._page_info(data))
                 elif data['type'] == 'message':
                     self.message_received.emit(
                         data['from_id'],
@@ -188,77 +331,161 @@ class ChatClient(QObject):
                         data['status']
                     )
         except websockets.exceptions.ConnectionClosed:
-            print("连接已关闭")
+            log.info("连接已关闭")
             self._connected = False
         except Exception as e:
-            print(f"消息接收错误: {e}")
+            log.error("消息接收错误", error=str(e))
             self._connected = False
             
-    async def get_chat_history(self, friend_nickname):
-        """获取聊天记录"""
+    async def get_chat_history(self, friend_nickname, before_id=None, limit=50, timeout=REQUEST_TIMEOUT):
+        """获取聊天记录
+
+        before_id 为 None 时获取最近一页，否则获取 before_id 之前的一页。
+        消息通过 history_received 信号分块送达，返回值为该页的分页信息，失败时返回 None。
+        """
         try:
-            print(f"请求聊天记录: friend_nickname={friend_nickname}")
+            log.debug("请求聊天记录", sample='get_history', friend_nickname=friend_nickname, before_id=before_id)
             if not self._connected:
-                print("未连接到服务器")
+                log.warning("未连接到服务器")
                 return None
                 
-            await self.websocket.send(json.dumps({
+            result = await self._request({
                 'type': 'get_history',
-                'friend_nickname': friend_nickname
-            }))
-            print(f"聊天记录请求已发送")
-            
-            # 等待服务器响应
-            message = await self.websocket.recv()
-            print(f"收到服务器响应: {message}")
-            result = json.loads(message)
-            
-            if result['type'] == 'history':
-                print(f"解析到聊天记录: {result['messages']}")
-                return result.get('messages', [])
-            return []
+                'friend_nickname': friend_nickname,
+                'before_id': before_id,
+                'limit': limit
+            }, timeout)
+            return self._page_info(result)
             
+        except asyncio.TimeoutError:
+            log.warning("获取聊天记录超时", friend_nickname=friend_nickname)
+            return None
         except Exception as e:
-            print(f"获取聊天记录失败: {e}")
-            return []
+            log.error("获取聊天记录失败", error=str(e))
+            return None
 
-    async def send_message(self, to_nickname, content, message_type='text'):
-        """发送消息"""
+    async def send_message(self, to_nickname, content, message_type='text', timeout=REQUEST_TIMEOUT):
+        """发送消息，服务器确认消息已保存后返回 True"""
         try:
             if not self._connected:
-                print("未连接到服务器")
+                log.warning("未连接到服务器")
                 return False
                 
-            await self.websocket.send(json.dumps({
+            ack = await self._request({
                 'type': 'message',
                 'to_nickname': to_nickname,
                 'content': content,
                 'message_type': message_type
-            }))
-            return True
+            }, timeout)
+            return bool(ack.get('success'))
+        except asyncio.TimeoutError:
+            log.warning("发送消息超时", to_nickname=to_nickname)
+            return False
         except Exception as e:
-            print(f"发送消息失败: {e}")
+            log.error("发送消息失败", error=str(e))
             return False
             
-    async def get_friends_list(self, user_id):
+    async def _group_request(self, payload, timeout):
+        """发送群聊相关请求，失败时返回 None"""
+        try:
+            if not self._connected:
+                log.warning("未连接到服务器")
+                return None
+            return await self._request(payload, timeout)
+        except asyncio.TimeoutError:
+            log.warning("群聊请求超时", op=payload['type'])
+            return None
+        except Exception as e:
+            log.error("群聊请求失败", op=payload['type'], error=str(e))
+            return None
+
+    async def create_group(self, name, timeout=REQUEST_TIMEOUT):
+        """创建群聊，返回群信息"""
+        result = await self._group_request({'type': 'create_group', 'name': name}, timeout)
+        return result.get('group') if result and result.get('success') else None
+
+    async def join_group(self, group_id, timeout=REQUEST_TIMEOUT):
+        """加入群聊，返回群信息"""
+        result = await self._group_request({'type': 'join_group', 'group_id': group_id}, timeout)
+        return result.get('group') if result and result.get('success') else None
+
+    async def leave_group(self, group_id, timeout=REQUEST_TIMEOUT):
+        """退出群聊"""
+        result = await self._group_request({'type': 'leave_group', 'group_id': group_id}, timeout)
+        return bool(result and result.get('success'))
+
+    async def get_groups(self, timeout=REQUEST_TIMEOUT):
+        """获取加入的群聊列表"""
+        result = await self._group_request({'type': 'get_groups'}, timeout)
+        return result.get('groups', []) if result else []
+
+    async def send_group_message(self, group_id, content, message_type='text', timeout=REQUEST_TIMEOUT):
+        """发送群消息，服务器确认消息已保存后返回 True"""
+        ack = await self._group_request({
+            'type': 'group_message',
+            'group_id': group_id,
+            'content': content,
+            'message_type': message_type
+        }, timeout)
+        return bool(ack and ack.get('success'))
+
+    async def get_group_history(self, group_id, before_id=None, limit=50, timeout=REQUEST_TIMEOUT):
+        """获取群聊记录，消息通过 history_received 信号分块送达，返回该页的分页信息"""
+        result = await self._group_request({
+            'type': 'get_group_history',
+            'group_id': group_id,
+            'before_id': before_id,
+            'limit': limit
+        }, timeout)
+        return self._page_info(result) if result else None
+
+    async def batch(self, ops, timeout=REQUEST_TIMEOUT):
+        """在一个帧中发送多个请求，服务器按顺序执行
+
+        ops 中每一项与单独发送时的请求相同。子响应照常触发各信号，
+        返回所有子响应帧的列表，失败时返回 None。聊天记录请求的响应不在返回的列表中，
+        它们照常分块送达 history_received 信号。
+        """
+        try:
+            if not self._connected:
+                log.warning("未连接到服务器")
+                return None
+                
+            result = await self._request({
+                'type': 'batch',
+                'ops': ops
+            }, timeout)
+            if not result.get('success'):
+                log.warning("批量请求失败", message=result.get('message'))
+                return None
+            return result.get('frames', [])
+        except asyncio.TimeoutError:
+            log.warning("批量请求超时")
+            return None
+        except Exception as e:
+            log.error("批量请求失败", error=str(e))
+            return None
+            
+    async def get_friends_list(self, user_id, timeout=REQUEST_TIMEOUT):
         """获取好友列表"""
         try:
             if not self._connected:
-                print(f"未连接到服务器 (_connected={self._connected})")
+                log.warning("未连接到服务器", connected=self._connected)
                 return
             if not self.websocket:
-                print("WebSocket 连接不存在")
+                log.warning("WebSocket 连接不存在")
                 return
                 
-            print(f"正在请求好友列表，用户ID: {user_id}")
-            await self.websocket.send(json.dumps({
+            log.debug("正在请求好友列表", user_id=user_id)
+            result = await self._request({
                 'type': 'get_friends',
                 'user_id': user_id
-            }))
-            print("好友列表请求已发送")
+            }, timeout)
+            return result.get('friends', [])
+        except asyncio.TimeoutError:
+            log.warning("请求好友列表超时")
         except Exception as e:
-            print(f"请求好友列表失败: {e}")
-            self._connected = False
+            log.error("请求好友列表失败", error=str(e))
             
     def close(self):
         """关闭连接"""
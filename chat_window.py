@@ -18,16 +18,20 @@ class ChatWindow(QMainWindow):
         self.current_friend = None
         self.my_avatar = None  # 存储自己的头像
         self.friend_avatars = {}  # 存储好友头像的字典
+        self.history_cursor = None  # 下一页更早聊天记录的 before_id
+        self.history_task = None  # 正在加载更早聊天记录的任务
         
         # 初始化UI
         self.init_ui()
         
         # 连接信号
         self.chat_client.message_received.connect(self.on_message_received)
+        self.chat_client.message_sent.connect(self.on_message_sent)
         self.chat_client.history_received.connect(self.on_history_received)
         self.chat_client.friends_list_received.connect(self.on_friends_list_received)
         self.chat_client.online_status_changed.connect(self.on_online_status_changed)
         self.chat_widget.message_sent.connect(self.send_message)
+        self.chat_widget.load_more_requested.connect(self.load_older_history)
         
         # 延迟请求好友列表
         QTimer.singleShot(1000, lambda: asyncio.create_task(self.load_friends_list()))
@@ -64,7 +68,7 @@ class ChatWindow(QMainWindow):
             # self.friend_list.clear()
             for friend in friends:
                 self.friend_avatars[friend['nickname']] = friend['avatar_path']  # 保存好友头像
-                self.friend_list.add_friend(friend['avatar_path'], friend['nickname'])
+                self.friend_list.add_friend(friend['avatar_path'], friend['nickname'], friend['user_id'])
         except Exception as e:
             print(f"处理好友列表失败: {e}")
             
@@ -73,6 +77,7 @@ class ChatWindow(QMainWindow):
         try:
             print(f"选中好友: {nickname}")
             self.current_friend = nickname
+            self.history_cursor = None
             
             # 清空聊天记录
             self.chat_widget.clear_messages()
@@ -102,6 +107,19 @@ class ChatWindow(QMainWindow):
         except Exception as e:
             print(f"处理收到的消��失败: {e}")
             
+    def on_message_sent(self, to_id, to_nickname, content, message_type):
+        """处理本账号在其他设备上发出的消息"""
+        try:
+            if to_nickname == self.current_friend:
+                self.chat_widget.add_message(
+                    content=content,
+                    is_send=True,
+                    avatar_path=self.my_avatar or 'bubble_message/data/head1.jpg',
+                    message_type=message_type
+                )
+        except Exception as e:
+            print(f"处理同步消息失败: {e}")
+            
     def send_message(self, content):
         """发送消息"""
         try:
@@ -126,25 +144,62 @@ class ChatWindow(QMainWindow):
             print(f"发送消息失败: {e}")
             QMessageBox.warning(self, "错误", f"发送消息失败: {str(e)}")
             
-    def on_history_received(self, messages):
-        """处理收到的聊天记录"""
+    def on_history_received(self, messages, page_info):
+        """处理收到的聊天记录
+
+        一页聊天记录分块到达，块之间从新到旧，每块都插入到当前显示的最上方。
+        before_id 为空时是最近一页，替换当前显示；否则是滚动到顶部加载的更早一页。
+        """
         try:
-            print(f"收到聊天记录消息: {messages}")
-            self.chat_widget.clear_messages()
-            for msg in messages:
-                print(f"处理消息: {msg}")
-                is_send = msg.get('is_send', False)
-                self.chat_widget.add_message(
-                    msg['content'],
-                    is_send,
-                    'bubble_message/data/head1.jpg' if is_send else 'bubble_message/data/head2.jpg',
-                    msg.get('type', 'text'),
-                    msg.get('timestamp')
-                )
-            print("聊天记录显示完成")
+            friend_nickname = page_info.get('friend_nickname')
+            if friend_nickname and friend_nickname != self.current_friend:
+                print(f"忽略非当前好友的聊天记录: {friend_nickname}")
+                return
+            
+            print(f"收到聊天记录消息: {len(messages)} 条")
+            if page_info.get('first') and page_info.get('before_id') is None:
+                self.chat_widget.clear_messages()
+                self.chat_widget.loading_history = True
+            
+            if messages:
+                self.chat_widget.prepend_messages([
+                    (
+                        msg['content'],
+                        msg.get('is_send', False),
+                        'bubble_message/data/head1.jpg' if msg.get('is_send', False) else 'bubble_message/data/head2.jpg',
+                        msg.get('type', 'text'),
+                        msg.get('timestamp')
+                    )
+                    for msg in messages
+                ])
+            
+            if page_info.get('done'):
+                if page_info.get('success', True):
+                    self.history_cursor = page_info.get('next_cursor')
+                    self.chat_widget.has_more_history = self.history_cursor is not None
+                    print("聊天记录显示完成")
+                else:
+                    # 获取失败时保留原来的游标，之后还能重新加载
+                    print("获取聊天记录失败")
+                self.chat_widget.loading_history = False
         except Exception as e:
+            self.chat_widget.loading_history = False
             print(f"显示聊天记录失败: {e}")
             
+    def load_older_history(self):
+        """滚动到顶部时加载更早的聊天记录"""
+        if not self.current_friend or self.history_cursor is None:
+            self.chat_widget.loading_history = False
+            return
+        self.history_task = asyncio.create_task(self._load_older_history(self.current_friend, self.history_cursor))
+        
+    async def _load_older_history(self, friend_nickname, before_id):
+        """请求更早的一页，超时或失败时没有 history_end，需要在这里清除加载状态"""
+        try:
+            await self.chat_client.get_chat_history(friend_nickname, before_id=before_id)
+        finally:
+            self.chat_widget.loading_history = False
+        
     def on_online_status_changed(self, user_id, status):
         """处理好友在线状态变化"""
         try:
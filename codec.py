@@ -0,0 +1,118 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec:
+    """标准库 json 编解码，发送文本帧
+
+    不声明子协议的旧客户端使用这种编码。
+    """
+
+    name = 'json'
+    subprotocol = 'sapphire.json'
+    binary = False
+
+    def encode(self, obj):
+        return json.dumps(obj)
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def with_id(self, payload, request_id):
+        """在已编码的对象前插入 id 字段，不重新编码其余部分"""
+        return '{"id": ' + self.encode(request_id) + ', ' + payload[1:]
+
+
+class OrjsonCodec(JsonCodec):
+    """orjson 编解码，线上格式仍是 JSON 文本帧"""
+
+    name = 'orjson'
+    subprotocol = 'sapphire.orjson'
+
+    def encode(self, obj):
+        return orjson.dumps(obj).decode()
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+
+class MsgpackCodec:
+    """MessagePack 编解码，发送二进制帧"""
+
+    name = 'msgpack'
+    subprotocol = 'sapphire.msgpack'
+    binary = True
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+    def with_id(self, payload, request_id):
+        """在已编码的 map 前插入 id 字段
+
+        少于 15 个字段的 fixmap 只需把首字节的字段数加一；其他情况（map16/map32）
+        插入后头部长度会变，重新解码后编码。
+        """
+        if 0x80 <= payload[0] < 0x8f:
+            return bytes([payload[0] + 1]) + self.encode('id') + self.encode(request_id) + payload[1:]
+        obj = self.decode(payload)
+        return self.encode({'id': request_id, **obj})
+
+
+JSON = JsonCodec()
+
+# 按优先顺序排列，只包含已安装依赖的编解码器
+CODECS = [JSON]
+if orjson is not None:
+    CODECS.insert(0, OrjsonCodec())
+if msgpack is not None:
+    CODECS.insert(0, MsgpackCodec())
+
+SUBPROTOCOLS = [codec.subprotocol for codec in CODECS]
+_BY_SUBPROTOCOL = {codec.subprotocol: codec for codec in CODECS}
+
+
+def codec_for(subprotocol):
+    """根据握手协商出的子协议返回编解码器，没有子协议时使用 JSON"""
+    return _BY_SUBPROTOCOL.get(subprotocol, JSON)
+
+
+def select_subprotocol(connection, subprotocols):
+    """服务器端子协议选择：按服务器的优先顺序选择客户端支持的编码
+
+    客户端没有声明或声明的都不支持时不选择子协议，按 JSON 处理，兼容旧客户端。
+    """
+    for subprotocol in SUBPROTOCOLS:
+        if subprotocol in subprotocols:
+            return subprotocol
+    return None
+
+
+class Frame:
+    """待推送的帧，每种编码只序列化一次
+
+    同一帧推送给使用不同编码的多个连接时使用。
+    """
+
+    __slots__ = ('obj', '_encoded')
+
+    def __init__(self, obj):
+        self.obj = obj
+        self._encoded = {}
+
+    def encode(self, codec):
+        frame = self._encoded.get(codec.name)
+        if frame is None:
+            frame = self._encoded[codec.name] = codec.encode(self.obj)
+        return frame
@@ -0,0 +1,158 @@
+import time
+from websockets.extensions.permessage_deflate import (
+    PerMessageDeflate,
+    ServerPerMessageDeflateFactory,
+    ClientPerMessageDeflateFactory,
+)
+from websockets.frames import CTRL_OPCODES, Opcode
+
+COMPRESSION_ENABLED = True  # 是否启用 permessage-deflate
+WINDOW_BITS = 12  # 压缩窗口大小（2 的幂），越大压缩率越高、每个连接占用内存越多
+MEMORY_LEVEL = 5  # zlib memLevel，1-9
+MIN_COMPRESS_SIZE = 512  # 小于该字节数的帧不压缩
+
+
+class CompressionStats:
+    """压缩的统计信息，所有连接共用一个"""
+
+    def __init__(self):
+        self.compressed = 0  # 压缩发送的帧数
+        self.skipped = 0  # 低于阈值、未压缩发送的帧数
+        self.bytes_in = 0  # 压缩前的字节数
+        self.bytes_out = 0  # 压缩后的字节数
+        self.compress_time = 0.0  # 压缩消耗的 CPU 时间（秒）
+        self.decompress_time = 0.0  # 解压收到的帧消耗的 CPU 时间（秒）
+
+    def as_dict(self):
+        return {
+            'compressed': self.compressed,
+            'skipped': self.skipped,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'bytes_saved': self.bytes_in - self.bytes_out,
+            'ratio': self.bytes_out / self.bytes_in if self.bytes_in else 1.0,
+            'compress_time': self.compress_time,
+            'decompress_time': self.decompress_time,
+        }
+
+
+class ThresholdDeflate(PerMessageDeflate):
+    """只压缩不小于 min_size 字节的消息的 permessage-deflate
+
+    协议允许同一连接上的消息各自决定是否压缩（RSV1 位），小帧压缩后几乎不变小，
+    跳过它们可以省下 CPU。
+    """
+
+    def __init__(self, *args, min_size=MIN_COMPRESS_SIZE, stats=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_size = min_size
+        self.stats = stats or CompressionStats()
+
+    def encode(self, frame):
+        if frame.opcode in CTRL_OPCODES:
+            return frame
+        # 只跳过完整的单帧消息，分片消息的后续帧必须和第一帧一致
+        if frame.fin and frame.opcode is not Opcode.CONT and len(frame.data) < self.min_size:
+            self.stats.skipped += 1
+            return frame
+        start = time.thread_time()
+        encoded = super().encode(frame)
+        self.stats.compress_time += time.thread_time() - start
+        self.stats.compressed += 1
+        self.stats.bytes_in += len(frame.data)
+        self.stats.bytes_out += len(encoded.data)
+        return encoded
+
+    def decode(self, frame, *, max_size=None):
+        if not frame.rsv1:
+            return super().decode(frame, max_size=max_size)
+        start = time.thread_time()
+        decoded = super().decode(frame, max_size=max_size)
+        self.stats.decompress_time += time.thread_time() - start
+        return decoded
+
+
+def _with_threshold(extension, min_size, stats):
+    """用协商好的参数创建 ThresholdDeflate"""
+    return ThresholdDeflate(
+        extension.remote_no_context_takeover,
+        extension.local_no_context_takeover,
+        extension.remote_max_window_bits,
+        extension.local_max_window_bits,
+        extension.compress_settings,
+        min_size=min_size,
+        stats=stats
+    )
+
+
+class ServerThresholdDeflateFactory(ServerPerMessageDeflateFactory):
+    def __init__(self, min_size, stats, **kwargs):
+        super().__init__(**kwargs)
+        self.min_size = min_size
+        self.stats = stats
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, _with_threshold(extension, self.min_size, self.stats)
+
+
+class ClientThresholdDeflateFactory(ClientPerMessageDeflateFactory):
+    def __init__(self, min_size, stats, **kwargs):
+        super().__init__(**kwargs)
+        self.min_size = min_size
+        self.stats = stats
+
+    def process_response_params(self, params, accepted_extensions):
+        extension = super().process_response_params(params, accepted_extensions)
+        return _with_threshold(extension, self.min_size, self.stats)
+
+
+class CompressionPolicy:
+    """WebSocket 压缩配置
+
+    用 server_options()/client_options() 的返回值作为 websockets.serve/connect 的参数。
+    关闭时完全不协商 permessage-deflate；开启时窗口大小和内存级别决定每个连接的
+    内存占用，min_size 以下的帧不压缩。
+    """
+
+    def __init__(self, enabled=COMPRESSION_ENABLED, window_bits=WINDOW_BITS,
+                 memory_level=MEMORY_LEVEL, min_size=MIN_COMPRESS_SIZE):
+        if not 9 <= window_bits <= 15:
+            raise ValueError(f"window_bits 必须在 9 到 15 之间: {window_bits}")
+        if not 1 <= memory_level <= 9:
+            raise ValueError(f"memory_level 必须在 1 到 9 之间: {memory_level}")
+        self.enabled = enabled
+        self.window_bits = window_bits
+        self.memory_level = memory_level
+        self.min_size = min_size
+        self.stats = CompressionStats()
+
+    def server_options(self):
+        """websockets.serve 的压缩相关参数"""
+        if not self.enabled:
+            return {'compression': None}
+        return {
+            'compression': None,  # 使用下面的扩展代替默认配置
+            'extensions': [ServerThresholdDeflateFactory(
+                self.min_size,
+                self.stats,
+                server_max_window_bits=self.window_bits,
+                client_max_window_bits=self.window_bits,
+                compress_settings={'memLevel': self.memory_level}
+            )]
+        }
+
+    def client_options(self):
+        """websockets.connect 的压缩相关参数"""
+        if not self.enabled:
+            return {'compression': None}
+        return {
+            'compression': None,
+            'extensions': [ClientThresholdDeflateFactory(
+                self.min_size,
+                self.stats,
+                server_max_window_bits=self.window_bits,
+                client_max_window_bits=self.window_bits,
+                compress_settings={'memLevel': self.memory_level}
+            )]
+        }
@@ -1,357 +1,577 @@
 import sqlite3
 import os
+import sys
+import queue
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote
+from migrations import migrate
+from log import get_logger
+from passwords import hash_password, verify_password
+
+READER_POOL_SIZE = 4  # 只读连接池大小
+
+log = get_logger('database')
+
+# 每个连接都会设置的 PRAGMA
+CONNECTION_PRAGMAS = (
+    'PRAGMA synchronous = NORMAL',  # WAL 模式下只在检查点时 fsync
+    'PRAGMA cache_size = -16000',  # 每个连接 16MB 页缓存
+    'PRAGMA mmap_size = 268435456',  # 256MB 内存映射读取
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA busy_timeout = 5000',
+)
+
+
+def conversation_id(user1_id, user2_id):
+    """两个用户之间会话的规范编号，与参数顺序无关"""
+    if user1_id > user2_id:
+        user1_id, user2_id = user2_id, user1_id
+    return f"{user1_id}:{user2_id}"
+
+
+def group_conversation_id(group_id):
+    """群聊会话编号"""
+    return f"g:{group_id}"
+
+
+# 一页聊天记录，按 message_id 倒序，参数为 (conversation_id, before_id, limit)
+HISTORY_PAGE_SQL = '''
+    SELECT
+        m.*,
+        sender.nickname as sender_nickname,
+        receiver.nickname as receiver_nickname
+    FROM chat_messages m
+    JOIN users sender ON m.from_user_id = sender.user_id
+    JOIN users receiver ON m.to_user_id = receiver.user_id
+    WHERE m.conversation_id = ? AND m.message_id < ?
+    ORDER BY m.message_id DESC
+    LIMIT ?
+'''
+
+
+# 一页群聊记录，群消息没有接收者
+GROUP_HISTORY_PAGE_SQL = '''
+    SELECT
+        m.*,
+        sender.nickname as sender_nickname,
+        NULL as receiver_nickname
+    FROM chat_messages m
+    JOIN users sender ON m.from_user_id = sender.user_id
+    WHERE m.conversation_id = ? AND m.message_id < ?
+    ORDER BY m.message_id DESC
+    LIMIT ?
+'''
+
+def _history_message(row, user_id):
+    """把聊天记录转换为发给 user_id 的字典"""
+    return {
+        'message_id': row['message_id'],
+        'content': row['content'],
+        'type': row['message_type'],
+        'timestamp': row['timestamp'],
+        'is_send': row['from_user_id'] == user_id,
+        'sender_nickname': row['sender_nickname'],
+        'receiver_nickname': row['receiver_nickname']
+    }
+
+
+def _user_dict(row):
+    """把用户记录转换为字典"""
+    return {
+        'user_id': row['user_id'],
+        'username': row['username'],
+        'nickname': row['nickname'],
+        'avatar_path': row['avatar_path']
+    }
+
 
 class Database:
-    def __init__(self):
-        # 获取当前文件所在目录
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        self.db_path = os.path.join(current_dir, "chat.db")
-        
-        # 连接数据库
-        self.conn = sqlite3.connect(self.db_path)
-        self.conn.row_factory = sqlite3.Row  # 设置行工厂，使结果可以通过列名访问
-        self.cursor = self.conn.cursor()
-        
+    """聊天数据库
+
+    使用 WAL 日志模式：所有写操作共用一个写连接并由锁串行化，
+    读操作从只读连接池中取连接，可以在多个线程中与写操作并发执行。
+    """
+
+    def __init__(self, db_path=None, readers=READER_POOL_SIZE):
+        # 默认使用当前文件所在目录下的 chat.db
+        if db_path is None:
+            current_dir = os.path.dirname(os.path.abspath(__file__))
+            db_path = os.path.join(current_dir, "chat.db")
+        self.db_path = db_path
+
+        # 写连接，所有写操作都在 _write_lock 下进行
+        self.conn = self._connect()
+        self._write_lock = threading.Lock()
+
         # 创建表
         self.create_tables()
-    
+
+        # 只读连接池。内存数据库无法在连接间共享，读操作直接使用写连接
+        self._readers = queue.Queue()
+        self._reader_conns = []
+        if db_path != ':memory:':
+            for _ in range(readers):
+                conn = self._connect(readonly=True)
+                self._reader_conns.append(conn)
+                self._readers.put(conn)
+
+    def _connect(self, readonly=False):
+        """创建数据库连接并设置 PRAGMA"""
+        if readonly:
+            uri = f"file:{quote(os.path.abspath(self.db_path))}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            conn.execute('PRAGMA query_only = ON')
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode = WAL')
+        conn.row_factory = sqlite3.Row  # 设置行工厂，使结果可以通过列名访问
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def _read(self):
+        """从连接池借出一个只读连接，返回其游标"""
+        if not self._reader_conns:
+            with self._write_lock:
+                yield self.conn.cursor()
+            return
+        conn = self._readers.get()
+        try:
+            yield conn.cursor()
+        finally:
+            self._readers.put(conn)
+
+    @contextmanager
+    def _write(self):
+        """获取写连接的游标，正常退出时提交，出错时回滚"""
+        with self._write_lock:
+            cursor = self.conn.cursor()
+            try:
+                yield cursor
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
     def create_tables(self):
-        """创建数据库表"""
+        """创建数据库表并升级到最新结构"""
         try:
-            # 创建用户表
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    password TEXT NOT NULL,
-                    nickname TEXT NOT NULL,
-                    avatar_path TEXT
-                )
-            ''')
-            
-            # 创建好友关系表
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS friends (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    friend_id INTEGER NOT NULL,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id),
-                    FOREIGN KEY (friend_id) REFERENCES users (user_id)
-                )
-            ''')
-            
-            # 创建聊天记录表
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS chat_messages (
-                    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    sender_id INTEGER NOT NULL,
-                    receiver_id INTEGER NOT NULL,
-                    content TEXT NOT NULL,
-                    message_type TEXT DEFAULT 'text',
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (sender_id) REFERENCES users (user_id),
-                    FOREIGN KEY (receiver_id) REFERENCES users (user_id)
-                )
-            ''')
-            self.conn.commit()
+            migrate(self.conn)
         except Exception as e:
-            print(f"创建表失败: {e}")
+            log.error("创建表失败", error=str(e))
             raise
-    
-    def add_user(self, username, password, nickname, avatar_path):
-        """注册新用户"""
+
+    def close(self):
+        """关闭所有连接"""
+        for conn in self._reader_conns:
+            conn.close()
+        self._reader_conns = []
+        self.conn.close()
+
+    def add_user(self, username, password, nickname, avatar_path, hashed=False):
+        """注册新用户
+
+        hashed 为 False 时在当前线程计算密码哈希；服务器在进程池中算好哈希后以 hashed=True 传入。
+        """
         try:
-            self.cursor.execute('''
-                INSERT INTO users (username, password, nickname, avatar_path)
-                VALUES (?, ?, ?, ?)
-            ''', (username, password, nickname, avatar_path))
-            self.conn.commit()
-            return self.cursor.lastrowid
+            if not hashed:
+                password = hash_password(password)
+            with self._write() as cursor:
+                cursor.execute('''
+                    INSERT INTO users (username, password, nickname, avatar_path)
+                    VALUES (?, ?, ?, ?)
+                ''', (username, password, nickname, avatar_path))
+                return cursor.lastrowid
         except Exception as e:
-            print(f"添加用户失败: {e}")
+            log.error("添加用户失败", error=str(e))
             return None
-            
-    def verify_user(self, username, password):
-        """验证用户登录"""
+
+    def get_credentials(self, username):
+        """获取用户信息和数据库中保存的密码（哈希或旧数据的明文），用户不存在时返回 None"""
         try:
-            self.cursor.execute('''
-                SELECT user_id, username, nickname, avatar_path
-                FROM users 
-                WHERE username = ? AND password = ?
-            ''', (username, password))
-            result = self.cursor.fetchone()
+            with self._read() as cursor:
+                cursor.execute('''
+                    SELECT user_id, username, nickname, avatar_path, password
+                    FROM users
+                    WHERE username = ?
+                ''', (username,))
+                result = cursor.fetchone()
             if result:
-                return {
-                    'user_id': result['user_id'],
-                    'username': result['username'],
-                    'nickname': result['nickname'],
-                    'avatar_path': result['avatar_path']
-                }
+                return _user_dict(result), result['password']
             return None
         except Exception as e:
-            print(f"验证用户失败: {e}")
+            log.error("获取用户密码失败", error=str(e))
+            return None
+
+    def update_password_hash(self, user_id, old_password, password_hash):
+        """把密码替换为新的哈希，期间密码被其他人修改过时不替换"""
+        try:
+            with self._write() as cursor:
+                cursor.execute('''
+                    UPDATE users SET password = ?
+                    WHERE user_id = ? AND password = ?
+                ''', (password_hash, user_id, old_password))
+                return cursor.rowcount > 0
+        except Exception as e:
+            log.error("更新密码哈希失败", error=str(e))
+            return False
+
+    def verify_user(self, username, password):
+        """验证用户登录，旧数据的明文密码校验通过后替换为哈希
+
+        在当前线程计算哈希，服务器使用 get_credentials 和 PasswordHasher 在进程池中校验。
+        """
+        try:
+            credentials = self.get_credentials(username)
+            if not credentials:
+                return None
+            user, stored = credentials
+            ok, needs_rehash = verify_password(password, stored)
+            if not ok:
+                return None
+            if needs_rehash:
+                self.update_password_hash(user['user_id'], stored, hash_password(password))
+            return user
+        except Exception as e:
+            log.error("验证用户失败", error=str(e))
             return None
-            
+
     def add_friend_request(self, user_id, friend_username):
         """发送好友请求"""
         try:
             friend = self.get_user_by_username(friend_username)
             if not friend:
                 return False, "用户不存在"
-                
-            # 检查是否已经是好友
-            self.cursor.execute('''
-                SELECT status FROM friendships 
-                WHERE (user_id = ? AND friend_id = ?) 
-                OR (user_id = ? AND friend_id = ?)
-            ''', (user_id, friend['user_id'], friend['user_id'], user_id))
-            
-            existing = self.cursor.fetchone()
-            if existing:
-                if existing['status'] == 'accepted':
-                    return False, "已经是好友"
-                elif existing['status'] == 'pending':
-                    return False, "好友请求待处理"
-                    
-            # 添加好友请求
-            self.cursor.execute('''
-                INSERT INTO friendships (user_id, friend_id, status)
-                VALUES (?, ?, 'pending')
-            ''', (user_id, friend['user_id']))
-            self.conn.commit()
+
+            with self._write() as cursor:
+                # 检查是否已经是好友
+                cursor.execute('''
+                    SELECT status FROM friendships
+                    WHERE (user_id = ? AND friend_id = ?)
+                    OR (user_id = ? AND friend_id = ?)
+                ''', (user_id, friend['user_id'], friend['user_id'], user_id))
+
+                existing = cursor.fetchone()
+                if existing:
+                    if existing['status'] == 'accepted':
+                        return False, "已经是好友"
+                    elif existing['status'] == 'pending':
+                        return False, "好友请求待处理"
+
+                # 添加好友请求
+                cursor.execute('''
+                    INSERT INTO friendships (user_id, friend_id, status)
+                    VALUES (?, ?, 'pending')
+                ''', (user_id, friend['user_id']))
             return True, "好友请求已发送"
         except Exception as e:
-            print(f"发送好友请求失败: {e}")
+            log.error("发送好友请求失败", error=str(e))
             return False, str(e)
-    
+
     def get_user(self, username):
         """获取用户信息"""
         try:
-            print(f"正在查询用户: {username}")
-            self.cursor.execute('''
-                SELECT user_id, username, nickname, avatar_path 
-                FROM users 
-                WHERE username = ?
-            ''', (username,))
-            result = self.cursor.fetchone()
-            print(f"查询结果: {result}")
+            with self._read() as cursor:
+                cursor.execute('''
+                    SELECT user_id, username, nickname, avatar_path
+                    FROM users
+                    WHERE username = ?
+                ''', (username,))
+                result = cursor.fetchone()
+            log.debug("查询用户", username=username, found=result is not None)
             return result
         except Exception as e:
-            print(f"查询用户失败: {e}")
+            log.error("查询用户失败", error=str(e))
             return None
-    
-    def get_user_by_id(self, user_id):
-        """通过ID获取用户信息"""
-        try:
-            self.cursor.execute('''
-                SELECT user_id, username, nickname, avatar_path 
-                FROM users 
-                WHERE user_id = ?
-            ''', (user_id,))
-            return self.cursor.fetchone()
-        except Exception as e:
-            print(f"通过ID查询用户失败: {e}")
-            return None
-    
-    def get_friends(self, user_id):
-        """获取用户的好友列表"""
-        try:
-            print(f"正在获取用户 {user_id} 的好友列表")
-            self.cursor.execute('''
-                SELECT u.user_id, u.username, u.nickname, u.avatar_path
-                FROM users u
-                INNER JOIN friendships f ON u.user_id = f.friend_id
-                WHERE f.user_id = ?
-            ''', (user_id,))
-            friends = self.cursor.fetchall()
-            print(f"查询到的好友列表: {friends}")
-            return friends
-        except Exception as e:
-            print(f"获取好友列表失败: {e}")
-            return []
-    
-    def save_message(self, from_user_id, to_user_id, content, message_type='text'):
-        """保存聊天消息到数据库"""
-        try:
-            self.cursor.execute('''
-                INSERT INTO chat_messages 
-                (from_user_id, to_user_id, content, message_type) 
-                VALUES (?, ?, ?, ?)
-            ''', (from_user_id, to_user_id, content, message_type))
-            self.conn.commit()
-            return True
-        except Exception as e:
-            print(f"保存消息失败: {e}")
-            return False
-    
-    def get_chat_history(self, user1_id, user2_id):
-        """获取两个用户之间的聊天记录"""
-        try:
-            self.cursor.execute('''
-                SELECT m.*, u1.nickname as from_nickname, u2.nickname as to_nickname
-                FROM chat_messages m
-                JOIN users u1 ON m.from_user_id = u1.user_id
-                JOIN users u2 ON m.to_user_id = u2.user_id
-                WHERE (m.from_user_id = ? AND m.to_user_id = ?)
-                OR (m.from_user_id = ? AND m.to_user_id = ?)
-                ORDER BY m.timestamp
-            ''', (user1_id, user2_id, user2_id, user1_id))
-            return self.cursor.fetchall()
-        except Exception as e:
-            print(f"获取聊天记录失败: {e}")
-            return []
-    
+
     def get_user_by_username(self, username):
         """通过用户名获取用户信息"""
         try:
-            print(f"正在查询用户: {username}")
-            self.cursor.execute('''
-                SELECT user_id, username, nickname, avatar_path 
-                FROM users 
-                WHERE username = ?
-            ''', (username,))
-            result = self.cursor.fetchone()
-            print(f"查询结果: {result}")
+            with self._read() as cursor:
+                cursor.execute('''
+                    SELECT user_id, username, nickname, avatar_path
+                    FROM users
+                    WHERE username = ?
+                ''', (username,))
+                result = cursor.fetchone()
+            log.debug("查询用户", username=username, found=result is not None)
             if result:
-                return {
-                    'user_id': result['user_id'],
-                    'username': result['username'],
-                    'nickname': result['nickname'],
-                    'avatar_path': result['avatar_path']
-                }
+                return _user_dict(result)
             return None
         except Exception as e:
-            print(f"通过用户名查询用户失败: {e}")
+            log.error("通过用户名查询用户失败", error=str(e))
             return None
-            
+
     def get_user_by_nickname(self, nickname):
         """通过昵称获取用户信息"""
         try:
-            self.cursor.execute('''
-                SELECT user_id, username, nickname, avatar_path 
-                FROM users 
-                WHERE nickname = ?
-            ''', (nickname,))
-            result = self.cursor.fetchone()
+            with self._read() as cursor:
+                cursor.execute('''
+                    SELECT user_id, username, nickname, avatar_path
+                    FROM users
+                    WHERE nickname = ?
+                ''', (nickname,))
+                result = cursor.fetchone()
             if result:
-                return {
-                    'user_id': result['user_id'],
-                    'username': result['username'],
-                    'nickname': result['nickname'],
-                    'avatar_path': result['avatar_path']
-                }
+                return _user_dict(result)
             return None
         except Exception as e:
-            print(f"通过昵称查询用户失败: {e}")
+            log.error("通过昵称查询用户失败", error=str(e))
             return None
-            
+
     def get_user_by_id(self, user_id):
         """通过ID获取用户信息"""
         try:
-            self.cursor.execute('''
-                SELECT user_id, username, nickname, avatar_path 
-                FROM users 
-                WHERE user_id = ?
-            ''', (user_id,))
-            result = self.cursor.fetchone()
+            with self._read() as cursor:
+                cursor.execute('''
+                    SELECT user_id, username, nickname, avatar_path
+                    FROM users
+                    WHERE user_id = ?
+                ''', (user_id,))
+                result = cursor.fetchone()
             if result:
-                return {
-                    'user_id': result['user_id'],
-                    'username': result['username'],
-                    'nickname': result['nickname'],
-                    'avatar_path': result['avatar_path']
-                }
+                return _user_dict(result)
             return None
         except Exception as e:
-            print(f"通过ID查询用户失败: {e}")
+            log.error("通过ID查询用户失败", error=str(e))
             return None
-            
+
     def get_friends(self, user_id):
         """获取用户的好友列表"""
         try:
-            print(f"正在获取用户 {user_id} 的好友列表")
-            self.cursor.execute('''
-                SELECT u.user_id, u.username, u.nickname, u.avatar_path
-                FROM users u
-                INNER JOIN friendships f ON u.user_id = f.friend_id
-                WHERE f.user_id = ?
-            ''', (user_id,))
-            friends = []
-            for row in self.cursor.fetchall():
-                friends.append({
-                    'user_id': row['user_id'],
-                    'username': row['username'],
-                    'nickname': row['nickname'],
-                    'avatar_path': row['avatar_path']
-                })
-            print(f"查询到的好友列表: {friends}")
+            with self._read() as cursor:
+                cursor.execute('''
+                    SELECT u.user_id, u.username, u.nickname, u.avatar_path
+                    FROM users u
+                    INNER JOIN friendships f ON u.user_id = f.friend_id
+                    WHERE f.user_id = ? AND f.status = 'accepted'
+                ''', (user_id,))
+                friends = [_user_dict(row) for row in cursor.fetchall()]
+            log.debug("查询好友列表", user_id=user_id, count=len(friends))
             return friends
         except Exception as e:
-            print(f"获取好友列表失败: {e}")
+            log.error("获取好友列表失败", error=str(e))
             return []
-    
+
     def add_friend(self, user_id, friend_id):
         """添加好友关系"""
         try:
-            # 添加正向关系
-            self.cursor.execute('''
-                INSERT INTO friendships (user_id, friend_id, status)
-                VALUES (?, ?, 'accepted')
-            ''', (user_id, friend_id))
-            
-            # 添加反向关系
-            self.cursor.execute('''
-                INSERT INTO friendships (user_id, friend_id, status)
-                VALUES (?, ?, 'accepted')
-            ''', (friend_id, user_id))
-            
-            self.conn.commit()
+            with self._write() as cursor:
+                # 添加正向关系
+                cursor.execute('''
+                    INSERT INTO friendships (user_id, friend_id, status)
+                    VALUES (?, ?, 'accepted')
+                ''', (user_id, friend_id))
+
+                # 添加反向关系
+                cursor.execute('''
+                    INSERT INTO friendships (user_id, friend_id, status)
+                    VALUES (?, ?, 'accepted')
+                ''', (friend_id, user_id))
             return True
         except Exception as e:
-            print(f"添加好友关系失败: {e}")
+            log.error("添加好友关系失败", error=str(e))
+            return False
+
+    def create_group(self, name, owner_id):
+        """创建群聊，创建者自动成为成员，返回 group_id"""
+        try:
+            with self._write() as cursor:
+                cursor.execute('''
+                    INSERT INTO groups (name, owner_id) VALUES (?, ?)
+                ''', (name, owner_id))
+                group_id = cursor.lastrowid
+                cursor.execute('''
+                    INSERT INTO group_members (group_id, user_id) VALUES (?, ?)
+                ''', (group_id, owner_id))
+            return group_id
+        except Exception as e:
+            log.error("创建群聊失败", error=str(e))
+            return None
+
+    def add_group_member(self, group_id, user_id):
+        """加入群聊，已是成员时也返回 True"""
+        try:
+            with self._write() as cursor:
+                cursor.execute('''
+                    INSERT OR IGNORE INTO group_members (group_id, user_id)
+                    SELECT group_id, ? FROM groups WHERE group_id = ?
+                ''', (user_id, group_id))
+                cursor.execute('''
+                    SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?
+                ''', (group_id, user_id))
+                return cursor.fetchone() is not None
+        except Exception as e:
+            log.error("加入群聊失败", error=str(e))
+            return False
+
+    def remove_group_member(self, group_id, user_id):
+        """退出群聊，返回是否确实退出"""
+        try:
+            with self._write() as cursor:
+                cursor.execute('''
+                    DELETE FROM group_members WHERE group_id = ? AND user_id = ?
+                ''', (group_id, user_id))
+                return cursor.rowcount > 0
+        except Exception as e:
+            log.error("退出群聊失败", error=str(e))
             return False
-    
+
+    def get_group(self, group_id):
+        """获取群聊信息"""
+        try:
+            with self._read() as cursor:
+                cursor.execute('''
+                    SELECT group_id, name, owner_id FROM groups WHERE group_id = ?
+                ''', (group_id,))
+                row = cursor.fetchone()
+            return dict(row) if row else None
+        except Exception as e:
+            log.error("获取群聊信息失败", error=str(e))
+            return None
+
+    def get_group_members(self, group_id):
+        """获取群成员的 user_id 列表"""
+        try:
+            with self._read() as cursor:
+                cursor.execute('''
+                    SELECT user_id FROM group_members WHERE group_id = ?
+                ''', (group_id,))
+                return [row[0] for row in cursor.fetchall()]
+        except Exception as e:
+            log.error("获取群成员失败", error=str(e))
+            return []
+
+    def get_user_groups(self, user_id):
+        """获取用户加入的群聊"""
+        try:
+            with self._read() as cursor:
+                cursor.execute('''
+                    SELECT g.group_id, g.name, g.owner_id
+                    FROM group_members gm
+                    JOIN groups g ON g.group_id = gm.group_id
+                    WHERE gm.user_id = ?
+                    ORDER BY g.group_id
+                ''', (user_id,))
+                return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            log.error("获取用户群聊失败", error=str(e))
+            return []
+
     def save_message(self, sender_id, receiver_id, content, message_type='text'):
         """保存聊天消息"""
         try:
-            self.cursor.execute('''
-                INSERT INTO chat_messages (from_user_id, to_user_id, content, message_type)
-                VALUES (?, ?, ?, ?)
-            ''', (sender_id, receiver_id, content, message_type))
-            self.conn.commit()
+            with self._write() as cursor:
+                cursor.execute('''
+                    INSERT INTO chat_messages (from_user_id, to_user_id, conversation_id, content, message_type)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (sender_id, receiver_id, conversation_id(sender_id, receiver_id), content, message_type))
             return True
         except Exception as e:
-            print(f"保存消息失败: {e}")
+            log.error("保存消息失败", error=str(e))
             return False
-            
-    def get_chat_history(self, user_id, friend_id):
-        """获取与指定好友的聊天记录"""
+
+    def save_messages(self, messages, delivered_ids=()):
+        """在一个事务中批量保存聊天消息
+
+        messages 为 (sender_id, receiver_id, content, message_type, timestamp, group_id) 元组列表，
+        group_id 不为空的是群消息，没有接收者，也不参与离线补发。
+        返回与之对应的 message_id 列表。delivered_ids 中的消息在同一事务中标记为已送达。
+        失败时整批回滚并抛出异常。
+        """
         try:
-            self.cursor.execute('''
-                SELECT 
-                    m.*,
-                    sender.nickname as sender_nickname,
-                    receiver.nickname as receiver_nickname
-                FROM chat_messages m
-                JOIN users sender ON m.from_user_id = sender.user_id
-                JOIN users receiver ON m.to_user_id = receiver.user_id
-                WHERE (m.from_user_id = ? AND m.to_user_id = ?)
-                   OR (m.from_user_id = ? AND m.to_user_id = ?)
-                ORDER BY m.timestamp ASC
-            ''', (user_id, friend_id, friend_id, user_id))
-            
-            messages = []
-            for row in self.cursor.fetchall():
-                messages.append({
-                    'content': row['content'],
-                    'type': row['message_type'],
-                    'timestamp': row['timestamp'],
-                    'is_send': row['from_user_id'] == user_id,
-                    'sender_nickname': row['sender_nickname'],
-                    'receiver_nickname': row['receiver_nickname']
-                })
-            print(f"获取到的聊天记录: {messages}")  # 调试输出
-            return messages
+            message_ids = []
+            with self._write() as cursor:
+                for sender_id, receiver_id, content, message_type, timestamp, group_id in messages:
+                    if group_id is None:
+                        conversation = conversation_id(sender_id, receiver_id)
+                    else:
+                        conversation = group_conversation_id(group_id)
+                    cursor.execute('''
+                        INSERT INTO chat_messages
+                        (from_user_id, to_user_id, conversation_id, content, message_type, timestamp, delivered)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ''', (sender_id, receiver_id, conversation, content, message_type, timestamp,
+                          int(group_id is not None)))
+                    message_ids.append(cursor.lastrowid)
+                if delivered_ids:
+                    cursor.executemany(
+                        'UPDATE chat_messages SET delivered = 1 WHERE message_id = ?',
+                        [(message_id,) for message_id in delivered_ids]
+                    )
+            return message_ids
         except Exception as e:
-            print(f"获取聊天记录失败: {e}")
-            return []
\ No newline at end of file
+            log.error("批量保存消息失败", error=str(e))
+            raise
+
+    def get_undelivered(self, user_id, after_id=0, limit=500):
+        """获取发给用户且尚未送达的消息，按 message_id 正序，从 after_id 之后开始"""
+        try:
+            with self._read() as cursor:
+                cursor.execute('''
+                    SELECT
+                        m.message_id, m.from_user_id, m.content, m.message_type, m.timestamp,
+                        sender.nickname as sender_nickname
+                    FROM chat_messages m
+                    JOIN users sender ON m.from_user_id = sender.user_id
+                    WHERE m.to_user_id = ? AND m.delivered = 0 AND m.message_id > ?
+                    ORDER BY m.message_id
+                    LIMIT ?
+                ''', (user_id, after_id, limit))
+                return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            log.error("获取离线消息失败", error=str(e))
+            return []
+
+    def iter_history(self, user_id, friend_id, before_id=None, limit=50,
+                     chunk_size=20, chunk_bytes=64 * 1024):
+        """逐块读取一页聊天记录，不把整页结果同时放在内存中
+
+        一页是 message_id 在 before_id 之前（不含）最近的 limit 条消息，before_id 为 None 时从最新的消息开始。
+        按块 yield (messages, next_cursor)：每块最多 chunk_size 条、内容约 chunk_bytes 字节，
+        块内按时间正序，块之间从新到旧。最后一次 yield 的 messages 为空列表，
+        next_cursor 为下一页的 before_id，没有更早的消息时为 None。
+        """
+        return self._iter_page(HISTORY_PAGE_SQL, conversation_id(user_id, friend_id), user_id,
+                               before_id, limit, chunk_size, chunk_bytes)
+
+    def iter_group_history(self, group_id, user_id, before_id=None, limit=50,
+                           chunk_size=20, chunk_bytes=64 * 1024):
+        """逐块读取一页群聊记录，块的顺序和含义与 iter_history 相同"""
+        return self._iter_page(GROUP_HISTORY_PAGE_SQL, group_conversation_id(group_id), user_id,
+                               before_id, limit, chunk_size, chunk_bytes)
+
+    def _iter_page(self, sql, conversation, user_id, before_id, limit, chunk_size, chunk_bytes):
+        # 每块单独查询（message_id < 上一块最早的 id），yield 前归还只读连接，
+        # 调用方等待慢速客户端时不会占用连接池
+        if before_id is None:
+            before_id = sys.maxsize
+        sent = 0
+        oldest_id = None
+        has_more = False
+        while sent < limit:
+            want = min(chunk_size, limit - sent)
+            with self._read() as cursor:
+                # 多取一条用于判断是否还有更早的消息
+                cursor.execute(sql, (conversation, before_id, want + 1))
+                rows = cursor.fetchall()
+            has_more = len(rows) > want
+            chunk = []
+            size = 0
+            for index, row in enumerate(rows[:want]):
+                chunk.append(_history_message(row, user_id))
+                size += len(row['content'] or '')
+                before_id = oldest_id = row['message_id']
+                if size >= chunk_bytes:
+                    has_more = has_more or index + 1 < len(rows)
+                    break
+            if not chunk:
+                break
+            sent += len(chunk)
+            chunk.reverse()
+            yield chunk, None
+            if not has_more:
+                break
+        yield [], oldest_id if has_more else None
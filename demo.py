@@ -7,6 +7,7 @@ import asyncio
 from qasync import QEventLoop
 from functools import partial
 from database import Database
+from log import setup_logging, shutdown_logging
 
 class ChatApp(QApplication):
     def __init__(self):
@@ -51,12 +52,15 @@ class ChatApp(QApplication):
             QMessageBox.critical(None, "错误", f"应用运行错误: {str(e)}")
 
 def main():
+    setup_logging()
     try:
         chat_app = ChatApp()
         chat_app.run()
     except Exception as e:
         print(f"程序启动失败: {e}")
         QMessageBox.critical(None, "错误", f"程序启动失败: {str(e)}")
+    finally:
+        shutdown_logging()
 
 if __name__ == '__main__':
     main()
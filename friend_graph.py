@@ -0,0 +1,141 @@
+from collections import OrderedDict
+from codec import Frame
+
+
+class FriendGraph:
+    """服务器内存中的好友关系图
+
+    每个用户的好友保存为邻接集合，首次访问时从数据库加载，按 user_id 做 LRU 淘汰。
+    friends_list 响应在第一次请求时生成并按编码缓存序列化结果，好友关系或用户资料变化
+    涉及到该用户时才重新生成，打开好友列表不再访问数据库。
+    好友关系的写入都经过这里，写入后调用 on_change(user_ids, profile) 通知其他进程。
+    """
+
+    def __init__(self, db, users, capacity=10000, on_change=None):
+        self.db = db  # AsyncDatabase
+        self.users = users  # UserDirectory
+        self.capacity = capacity
+        self.on_change = on_change  # 好友关系或用户资料变化后的回调
+        self._friends = OrderedDict()  # user_id -> 好友 user_id 集合
+        self._payloads = {}  # user_id -> friends_list 响应的 Frame，只缓存已加载好友集合的用户
+        self._generation = 0  # 每次失效加一，加载期间发生过失效的结果不放入缓存
+
+        # 统计信息
+        self.payload_hits = 0
+        self.payload_builds = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._friends)
+
+    def _put(self, user_id, friends):
+        """写入用户的好友集合，超过容量时淘汰最久未使用的用户"""
+        self._friends[user_id] = friends
+        self._friends.move_to_end(user_id)
+        while len(self._friends) > self.capacity:
+            evicted, _ = self._friends.popitem(last=False)
+            self._payloads.pop(evicted, None)
+            self.evictions += 1
+
+    async def _load(self, user_id):
+        """从数据库加载用户的好友，同时把好友资料放入用户缓存"""
+        generation = self._generation
+        friends = await self.db.get_friends(user_id)
+        for friend in friends:
+            self.users.put(friend)
+        friend_ids = {friend['user_id'] for friend in friends}
+        if generation == self._generation:
+            self._put(user_id, friend_ids)
+        return friend_ids
+
+    async def friends_of(self, user_id):
+        """获取用户的好友 user_id 集合"""
+        friends = self._friends.get(user_id)
+        if friends is None:
+            return await self._load(user_id)
+        self._friends.move_to_end(user_id)
+        return friends
+
+    async def get_friends_frame(self, user_id):
+        """获取用户的 friends_list 响应 Frame，序列化结果随 Frame 按编码缓存"""
+        frame = self._payloads.get(user_id)
+        if frame is None:
+            return await self._build_payload(user_id)
+        self._friends.move_to_end(user_id)
+        self.payload_hits += 1
+        return frame
+
+    async def _build_payload(self, user_id):
+        """生成用户的 friends_list 响应并缓存"""
+        generation = self._generation
+        friend_ids = await self.friends_of(user_id)
+        friends = []
+        for friend_id in sorted(friend_ids):
+            friend = await self.users.get_by_id(friend_id)
+            if friend:
+                friends.append({
+                    'user_id': friend['user_id'],
+                    'username': friend['username'],
+                    'nickname': friend['nickname'],
+                    'avatar_path': friend['avatar_path']
+                })
+        frame = Frame({
+            'type': 'friends_list',
+            'friends': friends
+        })
+        # 生成期间好友关系变化或该用户已被淘汰时不缓存，下次请求重新生成
+        if generation == self._generation and user_id in self._friends:
+            self._payloads[user_id] = frame
+        self.payload_builds += 1
+        return frame
+
+    async def add_friend(self, user_id, friend_id):
+        """添加好友关系"""
+        if not await self.db.add_friend(user_id, friend_id):
+            return False
+        self._changed([user_id, friend_id])
+        return True
+
+    async def add_friend_request(self, user_id, friend_username):
+        """发送好友请求，返回 (是否成功, 提示信息)"""
+        success, message = await self.db.add_friend_request(user_id, friend_username)
+        if success:
+            friend = await self.users.get_by_username(friend_username)
+            self._changed([user_id] + ([friend['user_id']] if friend else []))
+        return success, message
+
+    def invalidate_user(self, user_id):
+        """用户资料变化后调用，使该用户和其好友的好友列表缓存失效"""
+        self.users.invalidate(user_id)
+        self._changed([user_id], profile=True)
+
+    def _changed(self, user_ids, profile=False):
+        self.invalidate(user_ids)
+        if self.on_change is not None:
+            self.on_change(user_ids, profile)
+
+    def invalidate(self, user_ids):
+        """删除这些用户的好友集合和好友列表缓存，以及把他们列为好友的用户的好友列表缓存
+
+        本进程修改好友关系后由 _changed 调用，其他进程修改后由中转进程的广播触发。
+        变化很少发生，直接遍历所有已加载的好友集合。
+        """
+        self._generation += 1
+        user_ids = set(user_ids)
+        for user_id in user_ids:
+            self._friends.pop(user_id, None)
+            self._payloads.pop(user_id, None)
+        for owner_id, friends in self._friends.items():
+            if not user_ids.isdisjoint(friends):
+                self._payloads.pop(owner_id, None)
+
+    def stats(self):
+        """返回好友图的统计信息"""
+        return {
+            'users': len(self._friends),
+            'capacity': self.capacity,
+            'payloads': len(self._payloads),
+            'payload_hits': self.payload_hits,
+            'payload_builds': self.payload_builds,
+            'evictions': self.evictions,
+        }
@@ -6,8 +6,9 @@ import io
 import asyncio
 
 class FriendItem(QWidget):
-    def __init__(self, avatar_path, nickname):
+    def __init__(self, avatar_path, nickname, user_id=None):
         super().__init__()
+        self.user_id = user_id
         layout = QHBoxLayout()
         layout.setContentsMargins(5, 5, 5, 5)
         
@@ -40,11 +41,26 @@ class FriendItem(QWidget):
             }
         """)
         
+        # 在线状态
+        self.status_label = QLabel()
+        self.status_label.setStyleSheet("""
+            QLabel {
+                font-family: 微软雅黑;
+                font-size: 12px;
+                color: #999999;
+            }
+        """)
+        
         layout.addWidget(self.avatar_label)
         layout.addWidget(self.nickname_label)
         layout.addStretch()
+        layout.addWidget(self.status_label)
         self.setLayout(layout)
         
+    def set_status(self, status):
+        """显示好友在线状态"""
+        self.status_label.setText("在线" if status == 'online' else "")
+        
     def get_nickname(self):
         """获取好友昵称"""
         return self.nickname_label.text()
@@ -55,6 +71,7 @@ class FriendList(QWidget):
     def __init__(self, chat_window=None):
         super().__init__()
         self.chat_window = chat_window
+        self.pending_status = {}  # 好友列表加载前收到的在线状态
         self.init_ui()
         
     def init_ui(self):
@@ -83,15 +100,26 @@ class FriendList(QWidget):
         layout.addWidget(self.list_widget)
         self.setLayout(layout)
         
-    def add_friend(self, avatar_path, nickname):
+    def add_friend(self, avatar_path, nickname, user_id=None):
         """添加好友到列表"""
         item = QListWidgetItem()
-        friend_widget = FriendItem(avatar_path, nickname)
+        friend_widget = FriendItem(avatar_path, nickname, user_id)
+        if user_id in self.pending_status:
+            friend_widget.set_status(self.pending_status.pop(user_id))
         item.setSizeHint(friend_widget.sizeHint())
         
         self.list_widget.addItem(item)
         self.list_widget.setItemWidget(item, friend_widget)
         
+    def update_friend_status(self, user_id, status):
+        """更新好友在线状态，好友尚未加入列表时先记下来"""
+        for row in range(self.list_widget.count()):
+            friend_widget = self.list_widget.itemWidget(self.list_widget.item(row))
+            if friend_widget.user_id == user_id:
+                friend_widget.set_status(status)
+                return
+        self.pending_status[user_id] = status
+        
     def on_friend_selected(self, item):
         """当好友被选中时触发"""
         friend_widget = self.list_widget.itemWidget(item)
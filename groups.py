@@ -0,0 +1,120 @@
+import time
+
+MAX_GROUP_ID = 2 ** 63 - 1  # SQLite INTEGER 的上限
+
+
+def parse_group_id(value):
+    """把客户端传来的群号转换为 int，无效时返回 None
+
+    群的缓存以 int 为键，字符串形式的群号必须先转换，否则同一个群会缓存成两份。
+    """
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        return None
+    try:
+        group_id = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return group_id if 0 < group_id <= MAX_GROUP_ID else None
+
+
+class GroupService:
+    """群聊成员关系和群消息扇出
+
+    成员集合首次使用时从数据库加载并缓存在内存中，加入和退出时同时更新数据库和缓存。
+    群消息每种编码只序列化一次，用不阻塞的 offer() 放入每个在线成员连接的出站队列，
+    扇出的耗时只是每个连接一次入队操作，成员多的群也不会等待任何一个慢连接。
+    """
+
+    def __init__(self, db, get_sessions):
+        self.db = db  # AsyncDatabase
+        self.get_sessions = get_sessions  # user_id -> 该用户在线连接的列表
+        self._groups = {}  # group_id -> 群信息
+        self._members = {}  # group_id -> 成员 user_id 集合
+
+        # 统计信息
+        self.fanouts = 0
+        self.frames = 0
+        self.not_queued = 0
+        self.last_fanout_latency = 0.0
+        self.max_fanout_latency = 0.0
+
+    async def get_group(self, group_id):
+        """获取群信息，群不存在时返回 None"""
+        group = self._groups.get(group_id)
+        if group is None:
+            group = await self.db.get_group(group_id)
+            if group is None:
+                return None
+            self._groups[group_id] = group
+        return group
+
+    async def members_of(self, group_id):
+        """获取群成员集合，群不存在时返回空集合"""
+        members = self._members.get(group_id)
+        if members is None:
+            if await self.get_group(group_id) is None:
+                return set()
+            members = set(await self.db.get_group_members(group_id))
+            self._members[group_id] = members
+        return members
+
+    async def create(self, name, owner_id):
+        """创建群聊，返回群信息，失败时返回 None"""
+        group_id = await self.db.create_group(name, owner_id)
+        if group_id is None:
+            return None
+        group = {'group_id': group_id, 'name': name, 'owner_id': owner_id}
+        self._groups[group_id] = group
+        self._members[group_id] = {owner_id}
+        return group
+
+    async def join(self, group_id, user_id):
+        """加入群聊，群不存在时返回 False"""
+        if not await self.db.add_group_member(group_id, user_id):
+            return False
+        if group_id in self._members:
+            self._members[group_id].add(user_id)
+        return True
+
+    async def leave(self, group_id, user_id):
+        """退出群聊"""
+        if not await self.db.remove_group_member(group_id, user_id):
+            return False
+        if group_id in self._members:
+            self._members[group_id].discard(user_id)
+        return True
+
+    def invalidate(self, group_id):
+        """删除群的缓存，其他进程修改成员后调用"""
+        self._groups.pop(group_id, None)
+        self._members.pop(group_id, None)
+
+    def fanout(self, user_ids, frame, exclude=None):
+        """把 Frame 推送给这些用户在本进程的所有连接，跳过 exclude 连接，返回入队的帧数"""
+        start = time.perf_counter()
+        queued = 0
+        for user_id in user_ids:
+            for session in self.get_sessions(user_id):
+                if session is exclude:
+                    continue
+                if session.offer(frame.encode(session.codec)):
+                    queued += 1
+                else:
+                    self.not_queued += 1
+        latency = time.perf_counter() - start
+        self.fanouts += 1
+        self.frames += queued
+        self.last_fanout_latency = latency
+        self.max_fanout_latency = max(self.max_fanout_latency, latency)
+        return queued
+
+    def stats(self):
+        """返回群聊的统计信息"""
+        return {
+            'groups': len(self._members),
+            'fanouts': self.fanouts,
+            'frames': self.frames,
+            'not_queued': self.not_queued,
+            'last_fanout_latency': self.last_fanout_latency,
+            'max_fanout_latency': self.max_fanout_latency,
+        }
@@ -0,0 +1,83 @@
+import asyncio
+import time
+from metrics import Counter, Histogram
+
+
+class OpHandler:
+    """一种请求的处理函数，附带耗时、错误计数和可选的并发上限
+
+    limit 是与其他请求类型共用的 asyncio.Semaphore，传入时忽略 max_concurrency。
+    """
+
+    def __init__(self, op, func, max_concurrency=None, auth_required=True, limit=None):
+        self.op = op
+        self.func = func  # async func(session, data, sink)
+        self.auth_required = auth_required  # False 表示登录前也可以调用
+        self.max_concurrency = max_concurrency
+        if limit is None and max_concurrency:
+            limit = asyncio.Semaphore(max_concurrency)
+        self._limit = limit
+        self.in_flight = 0
+        self.latency = Histogram(f'{op}_latency_seconds', f'{op} 请求处理耗时')
+        self.calls = Counter(f'{op}_calls_total', f'{op} 请求数')
+        self.errors = Counter(f'{op}_errors_total', f'{op} 处理时抛出异常的请求数')
+
+    async def __call__(self, session, data, sink):
+        if self._limit is None:
+            return await self._timed(session, data, sink)
+        # 达到并发上限时排队等待，不拒绝请求
+        async with self._limit:
+            return await self._timed(session, data, sink)
+
+    async def _timed(self, session, data, sink):
+        self.calls.inc()
+        self.in_flight += 1
+        start = time.perf_counter()
+        try:
+            return await self.func(session, data, sink)
+        except Exception:
+            self.errors.inc()
+            raise
+        finally:
+            self.in_flight -= 1
+            self.latency.observe(time.perf_counter() - start)
+
+    def stats(self):
+        stats = self.latency.snapshot()
+        stats.update({
+            'calls': self.calls.value,
+            'errors': self.errors.value,
+            'in_flight': self.in_flight,
+            'max_concurrency': self.max_concurrency,
+        })
+        return stats
+
+
+class HandlerRegistry:
+    """请求类型到处理函数的登记表
+
+    新的请求类型只需登记处理函数，不用修改连接的读循环。
+    """
+
+    def __init__(self):
+        self._handlers = {}  # op -> OpHandler
+
+    def register(self, op, func, max_concurrency=None, auth_required=True, limit=None):
+        """登记 op 的处理函数，同名的旧处理函数被替换"""
+        handler = OpHandler(op, func, max_concurrency, auth_required, limit)
+        self._handlers[op] = handler
+        return handler
+
+    def get(self, op):
+        """返回 op 的处理函数，未登记时返回 None"""
+        return self._handlers.get(op)
+
+    def __contains__(self, op):
+        return op in self._handlers
+
+    def __iter__(self):
+        return iter(list(self._handlers.values()))
+
+    def stats(self):
+        """返回每种请求的统计信息"""
+        return {op: handler.stats() for op, handler in self._handlers.items()}
@@ -0,0 +1,148 @@
+import asyncio
+import math
+import time
+from codec import Frame
+from log import get_logger
+
+HEARTBEAT_INTERVAL = 30  # 连接空闲多久后发送 ping（秒）
+IDLE_TIMEOUT = 90  # 连接多久没有收到任何帧后关闭（秒）
+WHEEL_TICK = 1.0  # 时间轮每格的时长（秒）
+
+log = get_logger('heartbeat')
+
+
+class HeartbeatMonitor:
+    """用时间轮管理所有连接的心跳和空闲超时
+
+    每个连接只登记在时间轮的一个格子里，收到帧时只更新 session.last_seen，
+    不移动定时器。格子到期时再根据 last_seen 决定发送 ping、关闭连接或者
+    重新登记到更晚的格子。每格只处理到期的连接，开销不随连接总数增长。
+    """
+
+    def __init__(self, interval=HEARTBEAT_INTERVAL, timeout=IDLE_TIMEOUT, tick=WHEEL_TICK):
+        if timeout <= interval:
+            raise ValueError("空闲超时必须大于心跳间隔")
+        self.interval = interval
+        self.timeout = timeout
+        self.tick = tick
+        self._slots = [set() for _ in range(math.ceil(timeout / tick) + 1)]
+        self._slot_of = {}  # ClientSession -> 所在格子
+        self._pinged = {}  # ClientSession -> 最近一次发送 ping 的时间
+        self._position = 0
+        self._task = None
+        self._closing = set()  # 正在关闭超时连接的任务，保持引用直到完成
+
+        # 统计信息
+        self.pings = 0
+        self.reaped = 0
+        self.last_tick_sessions = 0
+        self.last_tick_duration = 0.0
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def start(self):
+        """启动时间轮"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止时间轮"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def add(self, session):
+        """登记新连接"""
+        session.last_seen = time.monotonic()
+        self._schedule(session, session.last_seen + self.interval)
+
+    def remove(self, session):
+        """注销连接"""
+        slot = self._slot_of.pop(session, None)
+        if slot is not None:
+            self._slots[slot].discard(session)
+        self._pinged.pop(session, None)
+
+    def _schedule(self, session, deadline):
+        """把连接放到 deadline 所在的格子"""
+        ticks = max(1, math.ceil((deadline - time.monotonic()) / self.tick))
+        ticks = min(ticks, len(self._slots) - 1)
+        slot = (self._position + ticks) % len(self._slots)
+        self._slots[slot].add(session)
+        self._slot_of[session] = slot
+
+    async def _run(self):
+        """每 tick 秒转动一格"""
+        next_tick = time.monotonic()
+        while True:
+            next_tick += self.tick
+            await asyncio.sleep(max(0, next_tick - time.monotonic()))
+            try:
+                self._advance()
+            except Exception as e:
+                log.error("心跳检查失败", error=str(e))
+
+    def _advance(self):
+        """处理当前格子中到期的连接"""
+        start = time.monotonic()
+        self._position = (self._position + 1) % len(self._slots)
+        due = self._slots[self._position]
+        self._slots[self._position] = set()
+        self.last_tick_sessions = len(due)
+
+        ping = None
+        expired = []
+        for session in due:
+            del self._slot_of[session]
+            if session.closed:
+                continue
+            idle = start - session.last_seen
+            if idle >= self.timeout:
+                expired.append(session)
+            elif idle < self.interval:
+                # 这段时间内收到过帧
+                self._schedule(session, session.last_seen + self.interval)
+            elif self._pinged.get(session, 0) < session.last_seen:
+                # 空闲了一个心跳间隔，且上次 ping 之后收到过帧，再发送一次 ping
+                if ping is None:
+                    ping = Frame({'type': 'ping'})
+                session.offer(ping.encode(session.codec), ephemeral=True)
+                self._pinged[session] = start
+                self.pings += 1
+                self._schedule(session, min(session.last_seen + self.timeout, start + self.interval))
+            else:
+                # 已发送 ping 还没有回应，等到超时
+                self._schedule(session, session.last_seen + self.timeout)
+
+        if expired:
+            self.reaped += len(expired)
+            log.info("关闭空闲连接", count=len(expired))
+            task = asyncio.create_task(self._close_all(expired))
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+        self.last_tick_duration = time.monotonic() - start
+
+    async def _close_all(self, sessions):
+        """批量关闭超时的连接，连接的读循环结束后会各自注销"""
+        for session in sessions:
+            self._pinged.pop(session, None)
+        await asyncio.gather(
+            *(session.websocket.close(1001, 'idle timeout') for session in sessions),
+            return_exceptions=True
+        )
+
+    def stats(self):
+        """返回心跳的统计信息"""
+        return {
+            'sessions': len(self._slot_of),
+            'awaiting_pong': sum(1 for session, sent in self._pinged.items() if sent >= session.last_seen),
+            'pings': self.pings,
+            'reaped': self.reaped,
+            'last_tick_sessions': self.last_tick_sessions,
+            'last_tick_duration': self.last_tick_duration,
+        }
@@ -0,0 +1,198 @@
+import bisect
+from contextlib import aclosing
+from collections import OrderedDict
+from database import conversation_id
+
+MESSAGE_OVERHEAD = 256  # 估算每条缓存消息除内容外占用的字节数
+
+
+class _Conversation:
+    """一个会话最近的消息
+
+    messages 是按 message_id 递增的、会话末尾连续的一段消息；
+    has_more 表示 messages 之前是否可能还有更早的消息。
+    """
+
+    __slots__ = ('messages', 'has_more', 'size')
+
+    def __init__(self):
+        self.messages = []
+        self.has_more = True
+        self.size = 0
+
+
+class HistoryCache:
+    """服务器端按会话缓存最近消息的环形缓冲区
+
+    每个会话最多保留最近 per_conversation 条消息，写入消息时追加，
+    第一次读取时用数据库返回的最新一页填充。最近几页的聊天记录请求直接由内存返回，
+    更早的分页回落到数据库。所有会话占用的内存超过 max_bytes 时按 LRU 淘汰空闲会话。
+    """
+
+    def __init__(self, db, per_conversation=200, max_bytes=64 * 1024 * 1024):
+        self.db = db  # AsyncDatabase
+        self.per_conversation = per_conversation
+        self.max_bytes = max_bytes
+        self._conversations = OrderedDict()  # conversation_id -> _Conversation
+        self.total_bytes = 0
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _message_size(message):
+        return len(message['content'] or '') + MESSAGE_OVERHEAD
+
+    def _touch(self, key, create=False):
+        """取出会话并标记为最近使用"""
+        entry = self._conversations.get(key)
+        if entry is None:
+            if not create:
+                return None
+            entry = self._conversations[key] = _Conversation()
+        self._conversations.move_to_end(key)
+        return entry
+
+    def _store(self, key, entry, messages):
+        """合并消息到会话中，只保留最近 per_conversation 条，然后检查内存上限"""
+        known = {message['message_id'] for message in entry.messages}
+        merged = entry.messages
+        for message in messages:
+            if message['message_id'] in known:
+                continue
+            if merged and message['message_id'] < merged[-1]['message_id']:
+                # 并发写入可能乱序提交，按 message_id 插入
+                ids = [m['message_id'] for m in merged]
+                merged.insert(bisect.bisect(ids, message['message_id']), message)
+            else:
+                merged.append(message)
+            entry.size += self._message_size(message)
+            self.total_bytes += self._message_size(message)
+
+        overflow = len(merged) - self.per_conversation
+        if overflow > 0:
+            for message in merged[:overflow]:
+                entry.size -= self._message_size(message)
+                self.total_bytes -= self._message_size(message)
+            del merged[:overflow]
+            entry.has_more = True
+        entry.messages = merged
+        self._evict(keep=key)
+
+    def _evict(self, keep=None):
+        """超过内存上限时淘汰最久未使用的会话"""
+        while self.total_bytes > self.max_bytes and len(self._conversations) > 1:
+            key, entry = next(iter(self._conversations.items()))
+            if key == keep:
+                self._conversations.move_to_end(key)
+                key, entry = next(iter(self._conversations.items()))
+            del self._conversations[key]
+            self.total_bytes -= entry.size
+            self.evictions += 1
+
+    def append(self, from_user_id, to_user_id, message_id, content, message_type, timestamp,
+               sender_nickname, receiver_nickname, create=True):
+        """记录一条刚保存的消息，create 为 False 时只追加到已缓存的会话"""
+        key = conversation_id(from_user_id, to_user_id)
+        entry = self._touch(key, create=create)
+        if entry is None:
+            return
+        self._store(key, entry, [{
+            'message_id': message_id,
+            'from_user_id': from_user_id,
+            'content': content,
+            'type': message_type,
+            'timestamp': timestamp,
+            'sender_nickname': sender_nickname,
+            'receiver_nickname': receiver_nickname
+        }])
+
+    def invalidate(self, user1_id, user2_id):
+        """删除一个会话的缓存"""
+        entry = self._conversations.pop(conversation_id(user1_id, user2_id), None)
+        if entry:
+            self.total_bytes -= entry.size
+
+    def _lookup(self, entry, before_id, limit):
+        """尝试从缓存中取一页，无法完整提供时返回 None"""
+        messages = entry.messages
+        if before_id is not None:
+            end = bisect.bisect_left([m['message_id'] for m in messages], before_id)
+        else:
+            end = len(messages)
+        start = max(0, end - limit)
+        if end - start < limit and entry.has_more:
+            return None
+        page = messages[start:end]
+        has_more = start > 0 or entry.has_more
+        next_cursor = page[0]['message_id'] if page and has_more else None
+        return page, next_cursor
+
+    async def iter_history(self, user_id, friend_id, before_id=None, limit=50, chunk_size=20):
+        """逐块获取一页聊天记录，块的顺序和含义与 Database.iter_history 相同"""
+        key = conversation_id(user_id, friend_id)
+        entry = self._touch(key)
+        if entry is not None:
+            result = self._lookup(entry, before_id, limit)
+            if result is not None:
+                self.hits += 1
+                page, next_cursor = result
+                for end in range(len(page), 0, -chunk_size):
+                    chunk = page[max(0, end - chunk_size):end]
+                    yield [self._for_user(message, user_id) for message in chunk], None
+                yield [], next_cursor
+                return
+
+        self.misses += 1
+        # 最新一页是会话末尾的连续消息，读完后用它填充缓存。
+        # 查询前先建好会话，查询期间其他进程广播来的新消息（append(create=False)）
+        # 会先记在会话里，填充时再合并，不会因为会话还不存在而丢掉
+        fill = [] if before_id is None else None
+        if fill is not None:
+            self._touch(key, create=True)
+        async with aclosing(self.db.iter_history(user_id, friend_id, before_id, limit, chunk_size)) as chunks:
+            async for messages, next_cursor in chunks:
+                if fill is not None:
+                    if messages:
+                        fill.extend(self._neutral(message, user_id, friend_id) for message in messages)
+                    else:
+                        fill.sort(key=lambda message: message['message_id'])
+                        entry = self._touch(key, create=True)
+                        entry.has_more = next_cursor is not None
+                        self._store(key, entry, fill)
+                yield messages, next_cursor
+
+    @staticmethod
+    def _neutral(message, user_id, friend_id):
+        """把针对某个用户的消息转换为与查看者无关的形式"""
+        neutral = dict(message)
+        neutral['from_user_id'] = user_id if neutral.pop('is_send') else friend_id
+        return neutral
+
+    @staticmethod
+    def _for_user(message, user_id):
+        """把缓存中的消息转换为针对查看者的形式"""
+        return {
+            'message_id': message['message_id'],
+            'content': message['content'],
+            'type': message['type'],
+            'timestamp': message['timestamp'],
+            'is_send': message['from_user_id'] == user_id,
+            'sender_nickname': message['sender_nickname'],
+            'receiver_nickname': message['receiver_nickname']
+        }
+
+    def stats(self):
+        """返回缓存的统计信息"""
+        total = self.hits + self.misses
+        return {
+            'conversations': len(self._conversations),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,212 @@
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+LOG_LEVEL = 'INFO'  # 默认的日志级别
+LOG_QUEUE_SIZE = 10000  # 等待后台线程输出的日志条数上限，超过时丢弃新日志
+
+_root = logging.getLogger('sapphire')
+_root.propagate = False
+
+_level = LOG_LEVEL
+_fmt = 'text'
+_stream = sys.stdout
+_listener = None
+_handler = None
+_sample_intervals = {}  # 采样键 -> 每多少条输出一条，0 表示不输出
+_sample_counters = {}  # (采样键, 事件) -> itertools.count，每处日志单独计数
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """只把日志记录放入队列的 Handler
+
+    标准库的 QueueHandler 会在调用线程中格式化消息，这里把格式化留给后台线程，
+    事件循环线程只付出创建 LogRecord 和一次入队的开销。
+    字段里的容器值在入队前做快照，避免后台线程格式化时调用方已经改动了它。
+    队列满时丢弃日志并计数，不阻塞调用方。
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        fields = getattr(record, 'fields', None)
+        if fields:
+            record.fields = {key: _snapshot(value) for key, value in fields.items()}
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _snapshot(value):
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    try:
+        return json.loads(json.dumps(value, ensure_ascii=False, default=str))
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def _format_field(value):
+    if isinstance(value, str):
+        if value and not any(c in value for c in ' "=\n'):
+            return value
+        return json.dumps(value, ensure_ascii=False)
+    if isinstance(value, (int, float, bool)) or value is None:
+        return str(value)
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """输出 `时间 级别 模块 事件 key=value ...` 格式的一行"""
+
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        parts = [
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.created)),
+            record.levelname,
+            record.name.rpartition('.')[2],
+            record.getMessage(),
+        ]
+        parts.extend(f'{key}={_format_field(value)}' for key, value in fields.items())
+        line = ' '.join(parts)
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出一行 JSON，便于日志系统解析"""
+
+    def format(self, record):
+        entry = {
+            'ts': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+FORMATTERS = {'text': TextFormatter, 'json': JsonFormatter}
+
+
+def parse_sample(specs):
+    """解析采样配置，每项形如 `get_history=0.01`，返回 {采样键: 比例}"""
+    rates = {}
+    for spec in specs or ():
+        key, _, rate = spec.partition('=')
+        rates[key.strip()] = float(rate)
+    return rates
+
+
+def _sampled(key, event):
+    """按采样比例决定这一条是否输出，用计数而不是随机数，开销只有两次字典查找和一次自增"""
+    interval = _sample_intervals.get(key)
+    if interval is None:
+        return True
+    if interval == 0:
+        return False
+    counter = _sample_counters.get((key, event))
+    if counter is None:
+        counter = _sample_counters[key, event] = itertools.count()
+    return next(counter) % interval == 0
+
+
+def setup_logging(level=None, sample=None, fmt=None, stream=None):
+    """配置日志：记录经队列交给后台线程格式化和输出
+
+    参数为 None 时沿用上一次的配置，多进程模式下子进程重新调用即可在本进程启动后台线程。
+    sample 是 {采样键: 比例}，比例 0.01 表示每 100 条只输出 1 条。
+    """
+    global _level, _fmt, _stream, _listener, _handler
+    if level is not None:
+        _level = level.upper() if isinstance(level, str) else level
+    if fmt is not None:
+        _fmt = fmt
+    if stream is not None:
+        _stream = stream
+    if sample is not None:
+        _sample_intervals.clear()
+        _sample_counters.clear()
+        for key, rate in sample.items():
+            _sample_intervals[key] = round(1 / rate) if rate > 0 else 0
+
+    # fork 出来的子进程继承了父进程的 Handler，但后台线程没有被继承，直接替换掉
+    if _handler is not None:
+        _root.removeHandler(_handler)
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    output = logging.StreamHandler(_stream)
+    output.setFormatter(FORMATTERS[_fmt]())
+    _listener = logging.handlers.QueueListener(log_queue, output)
+    _handler = _QueueHandler(log_queue)
+    _root.addHandler(_handler)
+    _root.setLevel(_level)
+    _listener.start()
+
+
+def shutdown_logging():
+    """输出队列中剩余的日志并停止后台线程"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def dropped():
+    """因队列满被丢弃的日志条数"""
+    return _handler.dropped if _handler is not None else 0
+
+
+class Logger:
+    """结构化日志：事件名加 key=value 字段
+
+    先检查级别再创建日志记录，级别关闭时调用的开销只有一次缓存的级别判断，
+    字段也不会被格式化。不要在调用处用 f-string 拼接字段，把值作为关键字参数传入，
+    格式化在后台线程完成。
+
+    debug() 可以指定 sample 采样键（通常是请求类型），按 setup_logging 的采样比例输出，
+    生产环境可以打开调试日志而只付出少量开销。
+    """
+
+    def __init__(self, name):
+        self._logger = _root.getChild(name)
+
+    def enabled(self, level=logging.DEBUG):
+        return self._logger.isEnabledFor(level)
+
+    def _log(self, level, event, fields, exc_info=False):
+        self._logger._log(level, event, (), exc_info=exc_info, extra={'fields': fields})
+
+    def debug(self, event, sample=None, **fields):
+        if self._logger.isEnabledFor(logging.DEBUG) and (sample is None or _sampled(sample, event)):
+            self._log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        if self._logger.isEnabledFor(logging.INFO):
+            self._log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        if self._logger.isEnabledFor(logging.WARNING):
+            self._log(logging.WARNING, event, fields)
+
+    def error(self, event, exc_info=False, **fields):
+        if self._logger.isEnabledFor(logging.ERROR):
+            self._log(logging.ERROR, event, fields, exc_info)
+
+
+def get_logger(name):
+    """获取模块的 Logger，name 通常是模块名"""
+    return Logger(name)
@@ -0,0 +1,137 @@
+import asyncio
+import time
+from metrics import Histogram
+from log import get_logger
+
+log = get_logger('message_writer')
+
+
+class MessageWriter:
+    """聊天消息的组提交写入器
+
+    save_message 每条消息都要一次 commit（一次 fsync）。这里把短时间内到达的
+    消息攒成一批，在一个事务里写入，每批只提交一次。
+    submit() 在消息所在的批次提交成功后才返回，调用方可以据此给发送者回执。
+    """
+
+    def __init__(self, db, max_batch=100, max_delay=0.005):
+        self.db = db  # AsyncDatabase
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = asyncio.Queue()
+        self._delivered = []  # 等待随下一批提交的已送达 message_id
+        self._task = None
+        self._pending = 0  # 已提交但尚未写入完成的消息数，不含 mark_delivered 的唤醒条目
+
+        # 统计信息
+        self.batches = 0
+        self.rows = 0
+        self.failed_batches = 0
+        self.last_batch_size = 0
+        self.last_flush_latency = 0.0  # 批次中最早一条消息从入队到提交完成的耗时（秒）
+        self.max_flush_latency = 0.0
+        self.flush_latency = Histogram('flush_latency_seconds', '消息从入队到所在批次提交的耗时')
+
+    @property
+    def depth(self):
+        """尚未持久化的消息数（包括正在提交的批次）"""
+        return self._pending
+
+    def start(self):
+        """启动后台写入任务"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """写完队列中剩余的消息后停止"""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    async def submit(self, sender_id, receiver_id, content, message_type='text', timestamp=None, group_id=None):
+        """提交一条消息，所在批次提交成功后返回 message_id
+
+        group_id 不为空时是群消息，receiver_id 为 None。
+        """
+        future = asyncio.get_running_loop().create_future()
+        row = (sender_id, receiver_id, content, message_type, timestamp, group_id)
+        self._queue.put_nowait((row, future, time.perf_counter()))
+        self._pending += 1
+        return await future
+
+    def mark_delivered(self, message_ids):
+        """标记消息已送达，随下一批写入一起提交，不等待提交完成"""
+        self._delivered.extend(message_ids)
+        # 放入一个不含消息的条目唤醒写入循环
+        self._queue.put_nowait((None, None, time.perf_counter()))
+
+    def stats(self):
+        """返回写入器的统计信息"""
+        return {
+            'depth': self.depth,
+            'batches': self.batches,
+            'rows': self.rows,
+            'failed_batches': self.failed_batches,
+            'last_batch_size': self.last_batch_size,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency,
+        }
+
+    async def _run(self):
+        """后台写入循环，收到 None 时写完已入队的消息后退出"""
+        while True:
+            first = await self._queue.get()
+            if first is None:
+                return
+            # 批次未满时等待一小段时间，让并发到达的消息进入同一批
+            if self._queue.qsize() + 1 < self.max_batch:
+                await asyncio.sleep(self.max_delay)
+            batch = [first]
+            stopping = False
+            while len(batch) < self.max_batch and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+            if stopping:
+                self._queue.put_nowait(None)
+
+    async def _flush(self, batch):
+        """在一个事务中写入一批消息和送达标记，并唤醒等待的发送者"""
+        if not batch:
+            return
+        # 唤醒条目没有消息，不计入批次大小和提交耗时
+        entries = [(row, future) for row, future, _ in batch if row is not None]
+        enqueued = [queued_at for row, _, queued_at in batch if row is not None]
+        delivered, self._delivered = self._delivered, []
+        if not entries and not delivered:
+            return
+        try:
+            message_ids = await self.db.save_messages([row for row, _ in entries], delivered)
+        except Exception as e:
+            self.failed_batches += 1
+            log.error("批量写入消息失败", rows=len(entries), error=str(e))
+            # 送达标记留到下一批重试
+            self._delivered[:0] = delivered
+            for _, future in entries:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._pending -= len(entries)
+
+        self.batches += 1
+        if entries:
+            latency = time.perf_counter() - min(enqueued)
+            self.rows += len(entries)
+            self.last_batch_size = len(entries)
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            self.flush_latency.observe(latency)
+        for (_, future), message_id in zip(entries, message_ids):
+            if not future.done():
+                future.set_result(message_id)
@@ -0,0 +1,194 @@
+import asyncio
+import bisect
+from log import get_logger
+
+# 默认的耗时分桶上界（秒）
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+log = get_logger('metrics')
+
+
+class Counter:
+    """只增不减的计数器"""
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    """按固定分桶统计的直方图，用于耗时分布
+
+    observe() 只做一次二分查找和几次加法，可以放在热路径上。
+    """
+
+    def __init__(self, name, help='', buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一个是超过所有上界的
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q):
+        """估算分位数，返回所在分桶的上界，超过所有上界时返回 inf"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for upper, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return upper
+        return float('inf')
+
+    def snapshot(self):
+        """返回直方图的摘要"""
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'avg': self.sum / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+        }
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class PrometheusWriter:
+    """生成 Prometheus 文本格式的指标
+
+    同一指标的样本按指标名收集，输出时排在一起，HELP/TYPE 只输出一次。
+    调用方可以按任意顺序写入，例如逐个请求类型写入多个带标签的指标。
+    """
+
+    def __init__(self):
+        self._families = {}  # 指标名 -> 该指标的行，按第一次写入的顺序输出
+
+    def _family(self, name, help, kind):
+        lines = self._families.get(name)
+        if lines is None:
+            lines = self._families[name] = [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+        return lines
+
+    def counter(self, name, help, value, labels=None):
+        self._family(name, help, 'counter').append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+
+    def gauge(self, name, help, value, labels=None):
+        self._family(name, help, 'gauge').append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+
+    def histogram(self, name, help, histogram, labels=None):
+        lines = self._family(name, help, 'histogram')
+        labels = dict(labels or {})
+        cumulative = 0
+        for upper, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            bucket_labels = _format_labels({**labels, 'le': _format_value(float(upper))})
+            lines.append(f'{name}_bucket{bucket_labels} {cumulative}')
+        lines.append(f'{name}_bucket{_format_labels({**labels, "le": "+Inf"})} {histogram.count}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}')
+        lines.append(f'{name}_count{_format_labels(labels)} {histogram.count}')
+
+    def render(self):
+        return '\n'.join(line for lines in self._families.values() for line in lines) + '\n'
+
+
+class LoopLagMonitor:
+    """测量事件循环延迟：定时 sleep，实际醒来时间比预期晚多少就是循环被占用的时间"""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.lag = Histogram('event_loop_lag_seconds', '事件循环延迟')
+        self.last_lag = 0.0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(0.0, loop.time() - expected)
+            self.lag.observe(self.last_lag)
+
+
+class MetricsServer:
+    """只提供 GET /metrics 的 HTTP 服务，collect(writer) 负责填充指标"""
+
+    def __init__(self, collect, host='0.0.0.0', port=9795):
+        self.collect = collect
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        log.info("指标服务已启动", port=self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            # 读完请求头，内容不需要
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                out = PrometheusWriter()
+                self.collect(out)
+                body = out.render().encode()
+                status = '200 OK'
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            else:
+                body = b'not found\n'
+                status = '404 Not Found'
+                content_type = 'text/plain'
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            log.error("处理指标请求失败", error=str(e))
+        finally:
+            writer.close()
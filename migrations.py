@@ -0,0 +1,186 @@
+"""数据库结构迁移
+
+每个迁移步骤有一个递增的版本号，已执行的版本记录在 schema_version 表中。
+启动时只执行尚未执行的步骤，每个步骤在单独的事务中完成，重复执行也是安全的。
+新增结构变更时在 MIGRATIONS 末尾追加步骤，不要修改已发布的步骤。
+"""
+from log import get_logger
+
+log = get_logger('migrations')
+
+
+def _columns(conn, table):
+    """返回表的列名集合，表不存在时返回空集合"""
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def _create_base_tables(conn):
+    """创建用户、好友关系和聊天记录表"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            nickname TEXT NOT NULL,
+            avatar_path TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS friendships (
+            user_id INTEGER,
+            friend_id INTEGER,
+            status TEXT DEFAULT 'pending',
+            FOREIGN KEY (user_id) REFERENCES users (user_id),
+            FOREIGN KEY (friend_id) REFERENCES users (user_id),
+            PRIMARY KEY (user_id, friend_id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            from_user_id INTEGER,
+            to_user_id INTEGER,
+            content TEXT,
+            message_type TEXT DEFAULT 'text',
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (from_user_id) REFERENCES users (user_id),
+            FOREIGN KEY (to_user_id) REFERENCES users (user_id)
+        )
+    ''')
+
+
+def _rename_message_columns(conn):
+    """旧版 create_tables 建的表使用 sender_id/receiver_id，统一为查询使用的列名"""
+    columns = _columns(conn, 'chat_messages')
+    if 'sender_id' in columns and 'from_user_id' not in columns:
+        conn.execute('ALTER TABLE chat_messages RENAME COLUMN sender_id TO from_user_id')
+    if 'receiver_id' in columns and 'to_user_id' not in columns:
+        conn.execute('ALTER TABLE chat_messages RENAME COLUMN receiver_id TO to_user_id')
+
+
+def _create_lookup_indexes(conn):
+    """为聊天记录、好友列表和昵称查询建立索引"""
+    # 聊天记录：两个方向的查询各是一次索引范围扫描
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_messages_pair
+        ON chat_messages (from_user_id, to_user_id, timestamp)
+    ''')
+    # 好友列表：覆盖索引，不需要回表读取 friendships
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_friendships_user_status
+        ON friendships (user_id, status, friend_id)
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_nickname ON users (nickname)')
+
+
+def _add_conversation_id(conn):
+    """聊天记录按会话编号存储，一个会话的记录是 (conversation_id, message_id) 上的一段连续索引"""
+    if 'conversation_id' not in _columns(conn, 'chat_messages'):
+        conn.execute('ALTER TABLE chat_messages ADD COLUMN conversation_id TEXT')
+    # 回填已有记录，编号规则与 database.conversation_id 一致
+    conn.execute('''
+        UPDATE chat_messages
+        SET conversation_id = MIN(from_user_id, to_user_id) || ':' || MAX(from_user_id, to_user_id)
+        WHERE conversation_id IS NULL
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_messages_conversation
+        ON chat_messages (conversation_id, message_id)
+    ''')
+    # 聊天记录不再按收发双方查询，去掉旧索引以减少写入开销
+    conn.execute('DROP INDEX IF EXISTS idx_chat_messages_pair')
+
+
+def _add_delivered_flag(conn):
+    """记录消息是否已推送给接收者，未推送的消息在接收者登录时批量补发"""
+    if 'delivered' not in _columns(conn, 'chat_messages'):
+        conn.execute('ALTER TABLE chat_messages ADD COLUMN delivered INTEGER NOT NULL DEFAULT 0')
+        # 迁移前的消息无法知道是否送达，视为已送达，避免登录时补发全部历史
+        conn.execute('UPDATE chat_messages SET delivered = 1')
+    # 部分索引只包含未送达的消息，按接收者和 message_id 有序
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_messages_undelivered
+        ON chat_messages (to_user_id, message_id)
+        WHERE delivered = 0
+    ''')
+
+
+def _create_group_tables(conn):
+    """群聊和群成员表，群消息存放在 chat_messages 中，会话编号为 g:<group_id>"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS groups (
+            group_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            owner_id INTEGER NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (owner_id) REFERENCES users (user_id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS group_members (
+            group_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (group_id) REFERENCES groups (group_id),
+            FOREIGN KEY (user_id) REFERENCES users (user_id),
+            PRIMARY KEY (group_id, user_id)
+        )
+    ''')
+    # 查询用户加入的群
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_group_members_user
+        ON group_members (user_id, group_id)
+    ''')
+
+
+# (版本号, 说明, 迁移函数)
+MIGRATIONS = [
+    (1, '创建基础表', _create_base_tables),
+    (2, '统一聊天记录表的列名', _rename_message_columns),
+    (3, '聊天记录、好友和昵称查询索引', _create_lookup_indexes),
+    (4, '聊天记录按会话编号索引', _add_conversation_id),
+    (5, '离线消息送达标记', _add_delivered_flag),
+    (6, '群聊', _create_group_tables),
+]
+
+
+def get_schema_version(conn):
+    """获取当前数据库结构版本"""
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+
+def migrate(conn):
+    """执行所有未执行的迁移步骤，返回迁移后的版本号"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+    current = get_schema_version(conn)
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+        try:
+            # 加写锁后再确认一次版本，避免多个进程同时执行同一步骤
+            conn.execute('BEGIN IMMEDIATE')
+            if get_schema_version(conn) >= version:
+                conn.commit()
+                continue
+            step(conn)
+            conn.execute(
+                'INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                (version, description)
+            )
+            conn.commit()
+            log.info("数据库迁移完成", version=version, description=description)
+        except Exception as e:
+            conn.rollback()
+            log.error("数据库迁移失败", version=version, description=description, error=str(e))
+            raise
+        current = version
+    return current
@@ -0,0 +1,132 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from metrics import Histogram
+
+# scrypt 参数：N=2^14, r=8 约占用 16MB 内存，单次计算几十毫秒
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_SIZE = 16
+KEY_SIZE = 32
+SCRYPT_MAXMEM = 64 * 1024 * 1024
+HASH_PREFIX = 'scrypt'
+HASH_WORKERS = max(1, (os.cpu_count() or 2) - 1)  # 留一个核给事件循环
+
+# 存储格式: scrypt$N$r$p$盐$哈希，盐和哈希是 base64
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                          dklen=KEY_SIZE, maxmem=SCRYPT_MAXMEM)
+
+
+def is_hashed(stored):
+    """数据库中的密码是否已经是哈希，旧数据是明文"""
+    return stored.startswith(HASH_PREFIX + '$')
+
+
+def hash_password(password):
+    """计算密码的 scrypt 哈希，返回可直接存入数据库的字符串"""
+    salt = os.urandom(SALT_SIZE)
+    key = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f'{HASH_PREFIX}${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64encode(salt)}${_b64encode(key)}'
+
+
+def verify_password(password, stored):
+    """校验密码，返回 (是否正确, 是否需要重新计算哈希)
+
+    旧数据中的明文密码和参数低于当前设置的哈希在校验通过后需要重新计算哈希。
+    """
+    if not is_hashed(stored):
+        ok = hmac.compare_digest(password.encode('utf-8'), stored.encode('utf-8'))
+        return ok, ok
+    try:
+        _, n, r, p, salt, key = stored.split('$')
+        n, r, p = int(n), int(r), int(p)
+        salt, key = base64.b64decode(salt), base64.b64decode(key)
+    except ValueError:
+        return False, False
+    ok = hmac.compare_digest(_scrypt(password, salt, n, r, p), key)
+    return ok, ok and (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+
+def _ignore_sigint():
+    """进程池的子进程忽略 Ctrl+C，由服务器进程负责关闭进程池"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class PasswordHasher:
+    """在进程池中计算和校验密码哈希
+
+    scrypt 每次要几十毫秒 CPU，放在事件循环或线程池里都会拖慢同一进程中的消息收发，
+    放到独立进程中执行后，服务器重启后的集中登录只会让登录排队，不影响已在线用户。
+    进程池在第一次使用时创建，用 forkserver 启动，不复制服务器进程中的线程和连接。
+    """
+
+    def __init__(self, workers=HASH_WORKERS):
+        self.workers = workers
+        self._executor = None
+
+        # 统计信息
+        self.latency = Histogram('password_hash_seconds', '密码哈希耗时（含排队）',
+                                 buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+        self.in_flight = 0
+        self.failures = 0
+        self.upgrades = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            self._executor = ProcessPoolExecutor(
+                self.workers,
+                mp_context=multiprocessing.get_context(method),
+                initializer=_ignore_sigint
+            )
+        return self._executor
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        self.in_flight += 1
+        try:
+            return await loop.run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self.in_flight -= 1
+            self.latency.observe(time.perf_counter() - start)
+
+    async def hash(self, password):
+        """计算密码哈希"""
+        return await self._run(hash_password, password)
+
+    async def verify(self, password, stored):
+        """校验密码，返回 (是否正确, 是否需要重新计算哈希)"""
+        ok, needs_rehash = await self._run(verify_password, password, stored)
+        if not ok:
+            self.failures += 1
+        return ok, needs_rehash
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self):
+        """返回密码哈希的统计信息"""
+        return {
+            'workers': self.workers,
+            'in_flight': self.in_flight,
+            'failures': self.failures,
+            'upgrades': self.upgrades,
+            **self.latency.snapshot(),
+        }
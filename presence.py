@@ -0,0 +1,104 @@
+import asyncio
+from codec import Frame
+from log import get_logger
+
+STATUS_ONLINE = 'online'
+STATUS_OFFLINE = 'offline'
+
+PRESENCE_WINDOW = 0.5  # 在线状态变化的合并窗口（秒）
+
+log = get_logger('presence')
+
+
+class PresenceService:
+    """在线状态服务
+
+    用户上线、下线时记录状态变化，每隔 window 秒统一发布一次，只发给在线的好友。
+    窗口内同一用户的多次变化只保留最后一次，最终状态与上次发布的相同则不发布，
+    频繁断线重连的客户端不会引起大量推送。
+    """
+
+    def __init__(self, friends, get_sessions, window=PRESENCE_WINDOW):
+        self.friends = friends  # FriendGraph
+        self.get_sessions = get_sessions  # user_id -> 该用户在线连接的列表
+        self.window = window
+        self._pending = {}  # user_id -> 窗口内最后一次状态
+        self._online = set()  # 已发布为在线的用户
+        self._flush_task = None
+
+        # 统计信息
+        self.changes = 0
+        self.published = 0
+        self.coalesced = 0
+        self.frames = 0
+
+    def is_online(self, user_id):
+        """用户当前是否已发布为在线"""
+        return user_id in self._online
+
+    def set_status(self, user_id, status):
+        """记录状态变化，在合并窗口结束时发布"""
+        self.changes += 1
+        self._pending[user_id] = status
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        """等待合并窗口结束后发布"""
+        try:
+            await asyncio.sleep(self.window)
+            await self.flush()
+        except Exception as e:
+            log.error("发布在线状态失败", error=str(e))
+        finally:
+            self._flush_task = None
+        # 发布期间又有新的变化，开始下一个窗口
+        if self._pending:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def flush(self):
+        """发布窗口内的状态变化"""
+        pending, self._pending = self._pending, {}
+        for user_id, status in pending.items():
+            was_online = user_id in self._online
+            if (status == STATUS_ONLINE) == was_online:
+                # 窗口内上线又下线（或相反），状态没有变化
+                self.coalesced += 1
+                continue
+            if status == STATUS_ONLINE:
+                self._online.add(user_id)
+            else:
+                self._online.discard(user_id)
+            self.published += 1
+
+            # 每次变化每种编码只序列化一次，推送给所有在线好友
+            frame = Frame({
+                'type': 'online_status',
+                'user_id': user_id,
+                'status': status
+            })
+            for friend_id in await self.friends.friends_of(user_id):
+                for session in self.get_sessions(friend_id):
+                    if session.offer(frame.encode(session.codec), ephemeral=True):
+                        self.frames += 1
+
+    async def send_snapshot(self, session):
+        """把好友当前的在线状态发给刚登录的连接"""
+        for friend_id in await self.friends.friends_of(session.user_id):
+            if friend_id in self._online:
+                session.offer(session.codec.encode({
+                    'type': 'online_status',
+                    'user_id': friend_id,
+                    'status': STATUS_ONLINE
+                }), ephemeral=True)
+
+    def stats(self):
+        """返回在线状态服务的统计信息"""
+        return {
+            'online': len(self._online),
+            'pending': len(self._pending),
+            'changes': self.changes,
+            'published': self.published,
+            'coalesced': self.coalesced,
+            'frames': self.frames,
+        }
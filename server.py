@@ -1,31 +1,718 @@
+import argparse
 import asyncio
+import heapq
+import multiprocessing
+import signal
+from multiprocessing.connection import wait
+import time
 import websockets
-import json
-from database import Database
-from chat_history import ChatHistory
+from async_database import AsyncDatabase
+from database import READER_POOL_SIZE
+from message_writer import MessageWriter
+from user_directory import UserDirectory
+from friend_graph import FriendGraph
+from history_cache import HistoryCache
+from session import ClientSession, SessionRegistry, OUTBOUND_QUEUE_SIZE, POLICY_SPILL, POLICIES
+from presence import PresenceService, STATUS_ONLINE, STATUS_OFFLINE
+from codec import Frame, codec_for, select_subprotocol
+from compression import CompressionPolicy, COMPRESSION_ENABLED, WINDOW_BITS, MEMORY_LEVEL, MIN_COMPRESS_SIZE
+from handlers import HandlerRegistry
+from heartbeat import HeartbeatMonitor, HEARTBEAT_INTERVAL, IDLE_TIMEOUT
+from broker import BROKER_PATH, BrokerClient, run_broker
+from groups import GroupService, parse_group_id
+from passwords import PasswordHasher
+from metrics import LoopLagMonitor, MetricsServer
+from log import get_logger, setup_logging, shutdown_logging, parse_sample, dropped as dropped_logs, LOG_LEVEL
+from contextlib import aclosing
 from datetime import datetime
+from functools import partial
+
+HISTORY_PAGE_SIZE = 50  # 每页聊天记录条数
+HISTORY_MAX_PAGE_SIZE = 200  # 客户端可请求的最大页大小
+HISTORY_CHUNK_SIZE = 20  # 每个 history_chunk 帧最多包含的消息数
+MAX_FRAME_SIZE = 1024 * 1024  # 客户端发来的单帧大小上限
+PENDING_BATCH_SIZE = 500  # 每个 pending_messages 帧最多包含的离线消息数
+HISTORY_MAX_CONCURRENCY = READER_POOL_SIZE  # 同时处理的聊天记录请求数上限（私聊和群聊合计），超过的排队
+DEFAULT_AVATAR = 'bubble_message/data/head1.jpg'  # 注册时的默认头像
+METRICS_PORT = 9795  # /metrics 的 HTTP 端口
+WORKER_SHUTDOWN_TIMEOUT = 5  # 多进程模式下等待子进程自行退出的时间（秒）
+GROUP_NAME_MAX_LENGTH = 64  # 群名称最大长度
+METRICS_TOP_QUEUES = 5  # /metrics 中单独列出出站队列最深的几个连接
+BATCH_MAX_OPS = 100  # 一个 batch 请求最多包含的子请求数
+BATCH_STREAMED_OPS = ('get_history', 'get_group_history')  # batch 中照常分块发送、不放进 batch_result 的请求
+PENDING_MESSAGE_FIELDS = ['message_id', 'content', 'message_type', 'timestamp']  # 离线消息数组的字段顺序
+
+log = get_logger('server')
+
+def reply(codec, request, frame):
+    """按连接的编码序列化对请求的响应，回显请求中的 id 以便客户端对应请求"""
+    if 'id' in request:
+        frame['id'] = request['id']
+    return codec.encode(frame)
+
+
+class ReplySink:
+    """把响应按连接的编码发往该连接
+
+    send 是登录后的 ClientSession.send 或登录前的 websocket.send。
+    """
+
+    def __init__(self, send, codec):
+        self._send = send
+        self.codec = codec
+
+    async def send(self, request, frame):
+        await self._send(reply(self.codec, request, frame))
+
+    async def send_frame(self, request, frame):
+        """发送可复用的 Frame，已编码的内容按编码缓存，只在前面插入 id"""
+        payload = frame.encode(self.codec)
+        if 'id' in request:
+            payload = self.codec.with_id(payload, request['id'])
+        await self._send(payload)
+
+
+class BatchSink:
+    """收集批量请求中各子请求的响应"""
 
-class ChatServer:
     def __init__(self):
-        self.db = Database()
-        self.clients = {}  # 存储客户端连接
+        self.frames = []
+
+    async def send(self, request, frame):
+        if 'id' in request:
+            frame['id'] = request['id']
+        self.frames.append(frame)
+
+    async def send_frame(self, request, frame):
+        await self.send(request, dict(frame.obj))
+
+
+class ChatServer:
+    def __init__(self, outbound_queue_size=OUTBOUND_QUEUE_SIZE, slow_consumer_policy=POLICY_SPILL, compression=None,
+                 heartbeat_interval=HEARTBEAT_INTERVAL, idle_timeout=IDLE_TIMEOUT):
+        self.db = AsyncDatabase()
+        self.writer = MessageWriter(self.db)  # 消息组提交写入器
+        self.users = UserDirectory(self.db)  # 用户信息缓存
+        self.friends = FriendGraph(self.db, self.users, on_change=self._friends_changed)  # 好友关系图
+        self.history = HistoryCache(self.db)  # 最近聊天记录缓存
+        self.clients = SessionRegistry()  # 在线连接，同一用户可以有多个设备
+        self.outbound_queue_size = outbound_queue_size  # 每个连接出站队列的长度
+        self.slow_consumer_policy = slow_consumer_policy  # 出站队列满时的处理策略
+        self.presence = PresenceService(self.friends, self.clients.sessions_of)  # 在线状态服务
+        self.compression = compression or CompressionPolicy()  # WebSocket 压缩配置
+        self.heartbeat = HeartbeatMonitor(heartbeat_interval, idle_timeout)  # 心跳和空闲连接回收
+        self.broker = None  # 多进程模式下到中转进程的连接
+        self.groups = GroupService(self.db, self.clients.sessions_of)  # 群聊成员和扇出
+        self.loop_lag = LoopLagMonitor()  # 事件循环延迟
+        self.passwords = PasswordHasher()  # 在进程池中计算密码哈希
+        self._password_upgrades = set()  # 正在把旧密码替换为哈希的后台任务
+        self.connections = 0  # 当前 WebSocket 连接数，包括尚未登录的
+        self.connections_total = 0
+        
+        # 请求处理函数
+        self.handlers = HandlerRegistry()
+        self.handlers.register('get_friends', self._handle_get_friends)
+        history_limit = asyncio.Semaphore(HISTORY_MAX_CONCURRENCY)  # 私聊和群聊记录共用
+        self.handlers.register('get_history', self._handle_get_history, max_concurrency=HISTORY_MAX_CONCURRENCY, limit=history_limit)
+        self.handlers.register('message', self._handle_message)
+        self.handlers.register('batch', self._handle_batch)
+        self.handlers.register('register', self._handle_register, auth_required=False)
+        self.handlers.register('ping', self._handle_ping, auth_required=False)
+        self.handlers.register('pong', self._handle_pong)
+        self.handlers.register('create_group', self._handle_create_group)
+        self.handlers.register('join_group', self._handle_join_group)
+        self.handlers.register('leave_group', self._handle_leave_group)
+        self.handlers.register('get_groups', self._handle_get_groups)
+        self.handlers.register('group_message', self._handle_group_message)
+        self.handlers.register('get_group_history', self._handle_get_group_history, max_concurrency=HISTORY_MAX_CONCURRENCY, limit=history_limit)
+        
+    async def user_online(self, user_id):
+        """用户在本进程的第一个连接登录"""
+        if self.broker is None:
+            self.presence.set_status(user_id, STATUS_ONLINE)
+        else:
+            # 在线状态由中转进程汇总所有进程后广播回来
+            await self.broker.user_online(user_id)
+            
+    def user_offline(self, user_id):
+        """用户在本进程的最后一个连接断开"""
+        if self.broker is None:
+            self.presence.set_status(user_id, STATUS_OFFLINE)
+        else:
+            self.broker.user_offline(user_id)
+            
+    def push(self, user_id, frame, message_id=None, exclude=None):
+        """把 Frame 推送给用户所有设备，包括其他进程上的设备
+
+        message_id 不为空时，任一设备写入连接后把该消息标记为已送达。
+        exclude 是不需要推送的本进程连接，通常是发出请求的那个设备。
+        """
+        self._push_local(user_id, frame, message_id, exclude)
+        if self.broker is not None:
+            self.broker.deliver(user_id, frame.obj, message_id)
+            
+    def _push_local(self, user_id, frame, message_id=None, exclude=None):
+        """推送到本进程上该用户每个设备的出站队列，不等待对方接收"""
+        devices = self.clients.sessions_of(user_id)
+        if not devices:
+            return
+        on_sent = partial(self.writer.mark_delivered, [message_id]) if message_id is not None else None
+        for device in devices:
+            if device is not exclude:
+                device.offer(frame.encode(device.codec), on_sent=on_sent)
+            
+    def handle_broker_event(self, message):
+        """处理中转进程转发来的事件"""
+        op = message['op']
+        if op == 'presence':
+            self.presence.set_status(message['user_id'], message['status'])
+        elif op == 'deliver':
+            self._push_local(message['user_id'], Frame(message['frame']), message['message_id'])
+        elif op == 'fanout':
+            self.groups.fanout(message['user_ids'], Frame(message['frame']))
+        elif op == 'broadcast':
+            if message['event'] == 'history_append':
+                # 其他进程保存的消息，只追加到已缓存的会话
+                self.history.append(*message['message'], create=False)
+            elif message['event'] == 'group_invalidate':
+                self.groups.invalidate(message['group_id'])
+            elif message['event'] == 'friends_invalidate':
+                if message['profile']:
+                    for user_id in message['user_ids']:
+                        self.users.invalidate(user_id)
+                self.friends.invalidate(message['user_ids'])
+            elif message['event'] == 'user_invalidate':
+                self.users.invalidate(username=message.get('username'))
+                self.users.invalidate(nickname=message.get('nickname'))
+                
+    def write_metrics(self, out):
+        """把服务器的指标写入 PrometheusWriter"""
+        out.gauge('sapphire_connections', '当前 WebSocket 连接数', self.connections)
+        out.counter('sapphire_connections_accepted_total', '累计 WebSocket 连接数', self.connections_total)
+        out.gauge('sapphire_sessions', '已登录的连接数', len(self.clients))
+        out.gauge('sapphire_online_users', '本进程上在线的用户数', self.clients.user_count())
+        
+        for handler in self.handlers:
+            labels = {'op': handler.op}
+            out.counter('sapphire_frames_total', '按请求类型统计的收到的请求数', handler.calls.value, labels)
+            out.counter('sapphire_handler_errors_total', '处理时抛出异常的请求数', handler.errors.value, labels)
+            out.gauge('sapphire_handler_in_flight', '正在处理的请求数', handler.in_flight, labels)
+            out.histogram('sapphire_handler_latency_seconds', '请求处理耗时', handler.latency, labels)
+            
+        for method, histogram in list(self.db.latency.items()):
+            out.histogram('sapphire_db_latency_seconds', '数据库调用耗时（含线程池排队）', histogram, {'method': method})
+            
+        depths = [session.depth for session in self.clients]
+        out.gauge('sapphire_outbound_queue_depth', '所有连接出站队列中等待发送的帧数', sum(depths))
+        out.gauge('sapphire_outbound_queue_depth_max', '最深的连接出站队列', max(depths, default=0))
+        out.counter('sapphire_outbound_dropped_total', '当前连接因队列满丢弃的帧数', sum(session.dropped for session in self.clients))
+        out.counter('sapphire_outbound_spilled_total', '当前连接因队列满留给离线补发的帧数', sum(session.spilled for session in self.clients))
+        # 总和与最大值看不出是哪些连接堆积，最深的几个连接按排名单独输出
+        deepest = heapq.nlargest(METRICS_TOP_QUEUES, self.clients, key=lambda session: session.depth)
+        for rank, session in enumerate(deepest, 1):
+            stats = session.stats()
+            labels = {'rank': rank, 'user_id': stats['user_id']}
+            out.gauge('sapphire_outbound_queue_top_depth', '出站队列最深的几个连接当前的队列长度', stats['depth'], labels)
+            out.gauge('sapphire_outbound_queue_top_max_depth', '这些连接出现过的最大队列长度', stats['max_depth'], labels)
+        
+        out.gauge('sapphire_writer_queue_depth', '尚未持久化的消息数', self.writer.depth)
+        out.counter('sapphire_messages_persisted_total', '已持久化的消息数', self.writer.rows)
+        out.counter('sapphire_writer_batches_total', '组提交批次数', self.writer.batches)
+        out.counter('sapphire_writer_failed_batches_total', '失败的组提交批次数', self.writer.failed_batches)
+        out.histogram('sapphire_writer_flush_latency_seconds', '消息从入队到提交的耗时', self.writer.flush_latency)
+        
+        out.gauge('sapphire_event_loop_lag_seconds', '最近一次测得的事件循环延迟', self.loop_lag.last_lag)
+        out.histogram('sapphire_event_loop_lag_distribution_seconds', '事件循环延迟分布', self.loop_lag.lag)
+        out.counter('sapphire_log_dropped_total', '因日志队列满丢弃的日志条数', dropped_logs())
+        
+        out.histogram('sapphire_password_hash_seconds', '密码哈希和校验耗时（含进程池排队）', self.passwords.latency)
+        out.gauge('sapphire_password_hash_in_flight', '等待或正在计算的密码哈希数', self.passwords.in_flight)
+        out.counter('sapphire_login_failures_total', '密码错误的登录次数', self.passwords.failures)
+        out.counter('sapphire_password_upgrades_total', '升级为新哈希的密码数', self.passwords.upgrades)
+        
+        users = self.users.stats()
+        out.gauge('sapphire_user_directory_size', '用户信息缓存中的用户数', users['size'])
+        out.gauge('sapphire_user_directory_capacity', '用户信息缓存的容量', users['capacity'])
+        out.counter('sapphire_user_directory_hits_total', '用户信息缓存命中次数', users['hits'])
+        out.counter('sapphire_user_directory_misses_total', '用户信息缓存未命中次数', users['misses'])
+        out.counter('sapphire_user_directory_evictions_total', '用户信息缓存淘汰的用户数', users['evictions'])
+        friends = self.friends.stats()
+        out.gauge('sapphire_friend_graph_users', '已加载好友关系的用户数', friends['users'])
+        out.gauge('sapphire_friend_graph_payloads', '已缓存的好友列表响应数', friends['payloads'])
+        out.counter('sapphire_friend_graph_payload_hits_total', '好友列表响应缓存命中次数', friends['payload_hits'])
+        out.counter('sapphire_friend_graph_payload_builds_total', '重新生成好友列表响应的次数', friends['payload_builds'])
+        out.counter('sapphire_friend_graph_evictions_total', '好友关系图淘汰的用户数', friends['evictions'])
+        
+        out.gauge('sapphire_history_cache_bytes', '聊天记录缓存占用的字节数', self.history.total_bytes)
+        out.counter('sapphire_history_cache_hits_total', '聊天记录缓存命中次数', self.history.hits)
+        out.counter('sapphire_history_cache_misses_total', '聊天记录缓存未命中次数', self.history.misses)
+        out.counter('sapphire_presence_published_total', '发布的在线状态变化数', self.presence.published)
+        out.counter('sapphire_heartbeat_reaped_total', '因空闲超时关闭的连接数', self.heartbeat.reaped)
+        out.counter('sapphire_group_fanout_frames_total', '群消息扇出入队的帧数', self.groups.frames)
+        compression = self.compression.stats
+        out.counter('sapphire_compression_bytes_in_total', '压缩前的字节数', compression.bytes_in)
+        out.counter('sapphire_compression_bytes_out_total', '压缩后的字节数', compression.bytes_out)
+        out.counter('sapphire_compression_seconds_total', '压缩消耗的 CPU 时间', compression.compress_time)
+        
+    async def send_pending_messages(self, session):
+        """把离线期间收到的消息按发送者分组，分批发给刚登录的用户
+
+        每批写入连接后，在下一次组提交中把这一批标记为已送达。
+        """
+        after_id = 0
+        while True:
+            pending = await self.db.get_undelivered(session.user_id, after_id, PENDING_BATCH_SIZE)
+            if not pending:
+                return
+            conversations = {}
+            for message in pending:
+                conversation = conversations.get(message['from_user_id'])
+                if conversation is None:
+                    conversation = conversations[message['from_user_id']] = {
+                        'from_id': message['from_user_id'],
+                        'from_nickname': message['sender_nickname'],
+                        'messages': []
+                    }
+                conversation['messages'].append([
+                    message['message_id'],
+                    message['content'],
+                    message['message_type'],
+                    message['timestamp']
+                ])
+            message_ids = [message['message_id'] for message in pending]
+            await session.send(session.codec.encode({
+                'type': 'pending_messages',
+                'fields': PENDING_MESSAGE_FIELDS,
+                'conversations': list(conversations.values())
+            }), on_sent=partial(self.writer.mark_delivered, message_ids))
+            log.info("已补发离线消息", user_id=session.user_id, count=len(pending))
+            if len(pending) < PENDING_BATCH_SIZE:
+                return
+            after_id = message_ids[-1]
+        
+    async def _dispatch(self, session, data, sink):
+        """执行一个请求，响应交给 sink，session 为 None 表示尚未登录"""
+        handler = self.handlers.get(data.get('type'))
+        if handler is None:
+            log.warning("未知的请求类型", op=data.get('type'))
+        elif handler.auth_required and session is None:
+            log.warning("请求需要先登录", op=data.get('type'))
+        else:
+            await handler(session, data, sink)
+            
+    async def _handle_ping(self, session, data, sink):
+        """客户端发起的心跳"""
+        await sink.send(data, {'type': 'pong'})
+        
+    async def _handle_pong(self, session, data, sink):
+        """对服务器 ping 的回应，收到帧时已经更新了 last_seen"""
+        
+    async def _handle_register(self, session, data, sink):
+        """注册新用户"""
+        username = data.get('username')
+        password = data.get('password')
+        nickname = data.get('nickname')
+        if not username or not password or not nickname:
+            await sink.send(data, {
+                'type': 'register',
+                'success': False,
+                'message': '用户名、密码和昵称不能为空'
+            })
+            return
+            
+        if await self.users.get_by_username(username):
+            message = '用户名已存在'
+        elif await self.users.get_by_nickname(nickname):
+            message = '昵称已存在'
+        else:
+            message = None
+        user_id = None
+        if not message:
+            password_hash = await self.passwords.hash(password)
+            user_id = await self.db.add_user(username, password_hash, nickname, DEFAULT_AVATAR)
+        if user_id:
+            # 清除可能缓存过的同名旧记录
+            self.users.invalidate(username=username)
+            self.users.invalidate(nickname=nickname)
+            if self.broker is not None:
+                self.broker.broadcast('user_invalidate', username=username, nickname=nickname)
+            log.info("新用户注册成功", username=username, user_id=user_id)
+        await sink.send(data, {
+            'type': 'register',
+            'success': bool(user_id),
+            'message': '注册成功' if user_id else (message or '注册失败')
+        })
+            
+    async def _verify_user(self, username, password):
+        """验证用户登录，成功时返回用户信息
+
+        密码在进程池中校验，旧的明文密码和参数过时的哈希在后台替换为新的哈希，不延迟登录响应。
+        """
+        credentials = await self.db.get_credentials(username)
+        if not credentials:
+            return None
+        user, stored = credentials
+        ok, needs_rehash = await self.passwords.verify(password, stored)
+        if not ok:
+            return None
+        if needs_rehash:
+            task = asyncio.create_task(self._upgrade_password(user['user_id'], stored, password))
+            self._password_upgrades.add(task)
+            task.add_done_callback(self._password_upgrades.discard)
+        return user
+        
+    async def _upgrade_password(self, user_id, stored, password):
+        try:
+            password_hash = await self.passwords.hash(password)
+            if await self.db.update_password_hash(user_id, stored, password_hash):
+                self.passwords.upgrades += 1
+                log.info("密码已升级为哈希", user_id=user_id)
+        except Exception as e:
+            log.error("升级密码哈希失败", user_id=user_id, error=str(e))
+            
+    async def _handle_batch(self, session, data, sink):
+        """按顺序执行 batch 中的子请求，响应合并为一个 batch_result 帧
+
+        聊天记录请求的响应可能很大，照常以 history_chunk/history_end 帧分块发送（在 batch_result 之前），
+        不放进 batch_result，避免一个 batch 产生超大帧。
+        """
+        ops = data.get('ops', [])
+        message = None
+        if not isinstance(ops, list):
+            message = 'ops 必须是数组'
+        elif len(ops) > BATCH_MAX_OPS:
+            message = f'批量请求最多包含 {BATCH_MAX_OPS} 个操作'
+        if message is not None:
+            await sink.send(data, {
+                'type': 'batch_result',
+                'success': False,
+                'message': message,
+                'frames': []
+            })
+            return
+        batch = BatchSink()
+        for index, op in enumerate(ops):
+            if not isinstance(op, dict):
+                # 不是对象的子请求无法回显 id，用位置标识
+                batch.frames.append({'type': 'error', 'index': index, 'message': '无效的请求'})
+                continue
+            op_type = op.get('type')
+            if op_type == 'batch':
+                log.warning("忽略嵌套的批量请求", user_id=session.user_id)
+                continue
+            try:
+                await self._dispatch(session, op, sink if op_type in BATCH_STREAMED_OPS else batch)
+            except Exception as e:
+                log.error("处理批量请求中的操作失败", op=op_type, error=str(e))
+                await batch.send(op, {'type': 'error', 'index': index, 'message': str(e)})
+        await sink.send(data, {
+            'type': 'batch_result',
+            'success': True,
+            'frames': batch.frames
+        })
+        
+    async def _handle_get_friends(self, session, data, sink):
+        # 好友列表响应已预先生成，直接发送
+        frame = await self.friends.get_friends_frame(session.user_id)
+        log.debug("发送好友列表", sample='get_friends', user_id=session.user_id)
+        await sink.send_frame(data, frame)
+        
+    async def _handle_get_history(self, session, data, sink):
+        friend_nickname = data.get('friend_nickname')
+        
+        async def chunks(before_id, limit):
+            friend = await self.users.get_by_nickname(friend_nickname)
+            if not friend:
+                log.warning("未找到好友", user_id=session.user_id, friend_nickname=friend_nickname)
+                return
+            async for chunk in self.history.iter_history(
+                session.user_id,
+                friend['user_id'],
+                before_id,
+                limit,
+                HISTORY_CHUNK_SIZE
+            ):
+                yield chunk
+                
+        await self._send_history_page(data, sink, chunks, {'friend_nickname': friend_nickname})
+        
+    async def _send_history_page(self, data, sink, chunks, fields):
+        """把一页聊天记录分块发送，最后发送带 next_cursor 的 history_end
+
+        chunks(before_id, limit) 返回逐块产生 (messages, next_cursor) 的异步生成器，
+        fields 是每帧都带上的会话标识。
+        """
+        before_id = data.get('before_id')
+        next_cursor = None
+        seq = 0
+        error = None
+        try:
+            # limit 小于 1 时返回的空页会被客户端当作没有更早的消息
+            limit = max(1, min(int(data.get('limit', HISTORY_PAGE_SIZE)), HISTORY_MAX_PAGE_SIZE))
+            if before_id is not None:
+                before_id = int(before_id)
+        except (TypeError, ValueError):
+            error = 'limit 和 before_id 必须是整数'
+            
+        if error is None:
+            try:
+                # 逐块发送，避免整页聊天记录放在一个大帧里
+                async with aclosing(chunks(before_id, limit)) as page:
+                    async for messages, next_cursor in page:
+                        if not messages:
+                            continue  # 最后一块只携带 next_cursor
+                        await sink.send(data, {
+                            'type': 'history_chunk',
+                            **fields,
+                            'before_id': before_id,
+                            'seq': seq,
+                            'messages': messages
+                        })
+                        seq += 1
+                log.debug("聊天记录已发送", sample=data.get('type'), chunks=seq, **fields)
+            except Exception as e:
+                log.error("处理聊天记录请求失败", error=str(e), **fields)
+                error = '获取聊天记录失败'
+                next_cursor = None
+                
+        end = {
+            'type': 'history_end',
+            **fields,
+            'before_id': before_id,
+            'next_cursor': next_cursor,
+            'chunks': seq
+        }
+        if error is not None:
+            # 失败时带上 success，客户端不会把没有 next_cursor 当作已经到头
+            end.update(success=False, message=error)
+        await sink.send(data, end)
+            
+    async def _handle_message(self, session, data, sink):
+        user = session.user
+        try:
+            to_nickname = data['to_nickname']
+            content = data['content']
+            message_type = data.get('message_type', 'text')
+            
+            to_user = await self.users.get_by_nickname(to_nickname)
+            if not to_user:
+                # 接收者不存在时也要回执，否则客户端会一直等到请求超时
+                raise ValueError('接收者不存在')
+                
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            
+            # 保存消息到数据库，所在批次提交后才返回
+            message_id = await self.writer.submit(
+                user['user_id'],
+                to_user['user_id'],
+                content,
+                message_type,
+                timestamp
+            )
+            
+            cached = [
+                user['user_id'],
+                to_user['user_id'],
+                message_id,
+                content,
+                message_type,
+                timestamp,
+                user['nickname'],
+                to_user['nickname']
+            ]
+            self.history.append(*cached)
+            if self.broker is not None:
+                self.broker.broadcast('history_append', message=cached)
+            
+            # 消息已持久化，给发送者回执
+            await sink.send(data, {
+                'type': 'message_ack',
+                'success': True,
+                'message_id': message_id,
+                'timestamp': timestamp
+            })
+            
+            # 推送给接收者在线的设备，任一设备写入连接后标记为已送达，
+            # 否则留给接收者下次登录时补发
+            frame = Frame({
+                'type': 'message',
+                'message_id': message_id,
+                'from_id': user['user_id'],
+                'from_nickname': user['nickname'],
+                'to_id': to_user['user_id'],
+                'to_nickname': to_user['nickname'],
+                'content': content,
+                'message_type': message_type,
+                'timestamp': timestamp
+            })
+            self.push(to_user['user_id'], frame, message_id)
+            # 同步给发送者的其他设备，发出消息的设备已经收到回执
+            if to_user['user_id'] != user['user_id']:
+                self.push(user['user_id'], frame, exclude=session)
+        except Exception as e:
+            log.error("处理消息失败", user_id=session.user_id, error=str(e))
+            await sink.send(data, {
+                'type': 'message_ack',
+                'success': False,
+                'message': str(e)
+            })
+        
+    def _friends_changed(self, user_ids, profile):
+        """好友关系或用户资料变化后通知其他进程"""
+        if self.broker is not None:
+            self.broker.broadcast('friends_invalidate', user_ids=user_ids, profile=profile)
+            
+    def _group_changed(self, group_id):
+        """群成员变化后通知其他进程"""
+        if self.broker is not None:
+            self.broker.broadcast('group_invalidate', group_id=group_id)
+            
+    async def _handle_create_group(self, session, data, sink):
+        name = str(data.get('name') or '').strip()
+        group = None
+        if name and len(name) <= GROUP_NAME_MAX_LENGTH:
+            group = await self.groups.create(name, session.user_id)
+        await sink.send(data, {
+            'type': 'group_created',
+            'success': group is not None,
+            'group': group,
+            'message': None if group else '群名称无效或创建失败'
+        })
+        
+    async def _handle_join_group(self, session, data, sink):
+        group_id = parse_group_id(data.get('group_id'))
+        if group_id is None:
+            await sink.send(data, {'type': 'group_joined', 'success': False, 'group': None, 'message': '群号无效'})
+            return
+        success = await self.groups.join(group_id, session.user_id)
+        if success:
+            self._group_changed(group_id)
+        await sink.send(data, {
+            'type': 'group_joined',
+            'success': success,
+            'group': await self.groups.get_group(group_id) if success else None
+        })
+        
+    async def _handle_leave_group(self, session, data, sink):
+        group_id = parse_group_id(data.get('group_id'))
+        if group_id is None:
+            await sink.send(data, {'type': 'group_left', 'success': False, 'group_id': None, 'message': '群号无效'})
+            return
+        success = await self.groups.leave(group_id, session.user_id)
+        if success:
+            self._group_changed(group_id)
+        await sink.send(data, {
+            'type': 'group_left',
+            'success': success,
+            'group_id': group_id
+        })
+        
+    async def _handle_get_groups(self, session, data, sink):
+        await sink.send(data, {
+            'type': 'groups_list',
+            'groups': await self.db.get_user_groups(session.user_id)
+        })
+        
+    async def _handle_group_message(self, session, data, sink):
+        user = session.user
+        try:
+            group_id = parse_group_id(data.get('group_id'))
+            if group_id is None:
+                raise ValueError('群号无效')
+            content = data['content']
+            message_type = data.get('message_type', 'text')
+            
+            members = await self.groups.members_of(group_id)
+            if user['user_id'] not in members:
+                raise ValueError('不是该群成员')
+                
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            message_id = await self.writer.submit(
+                user['user_id'],
+                None,
+                content,
+                message_type,
+                timestamp,
+                group_id
+            )
+            
+            await sink.send(data, {
+                'type': 'message_ack',
+                'success': True,
+                'message_id': message_id,
+                'timestamp': timestamp
+            })
+            
+            # 只序列化一次，推送给所有在线成员（包括发送者的其他设备）
+            frame = Frame({
+                'type': 'group_message',
+                'group_id': group_id,
+                'message_id': message_id,
+                'from_id': user['user_id'],
+                'from_nickname': user['nickname'],
+                'content': content,
+                'message_type': message_type,
+                'timestamp': timestamp
+            })
+            self.groups.fanout(members, frame, exclude=session)
+            if self.broker is not None:
+                self.broker.fanout(list(members), frame.obj)
+        except Exception as e:
+            log.error("处理群消息失败", user_id=session.user_id, group_id=data.get('group_id'), error=str(e))
+            await sink.send(data, {
+                'type': 'message_ack',
+                'success': False,
+                'message': str(e)
+            })
+            
+    async def _handle_get_group_history(self, session, data, sink):
+        group_id = parse_group_id(data.get('group_id'))
+        if group_id is None:
+            await sink.send(data, {
+                'type': 'history_end',
+                'success': False,
+                'message': '群号无效',
+                'group_id': None,
+                'before_id': data.get('before_id'),
+                'next_cursor': None,
+                'chunks': 0
+            })
+            return
+        
+        async def chunks(before_id, limit):
+            if session.user_id not in await self.groups.members_of(group_id):
+                log.warning("用户不是群成员", user_id=session.user_id, group_id=group_id)
+                return
+            async for chunk in self.db.iter_group_history(
+                group_id,
+                session.user_id,
+                before_id,
+                limit,
+                HISTORY_CHUNK_SIZE
+            ):
+                yield chunk
+                
+        await self._send_history_page(data, sink, chunks, {'group_id': group_id})
         
     async def handle_client(self, websocket):
+        self.connections += 1
+        self.connections_total += 1
+        session = None
+        # 握手时协商的编码，没有子协议的旧客户端使用 JSON
+        codec = codec_for(websocket.subprotocol)
         try:
-            # 处理登录
-            auth_message = await websocket.recv()
-            auth_data = json.loads(auth_message)
-            print(f"收到认证消息: {auth_message}")
+            # 处理登录，登录前连接还没有登记到时间轮，第一帧同样按空闲超时等待
+            auth_message = await asyncio.wait_for(websocket.recv(), self.heartbeat.timeout)
+            auth_data = codec.decode(auth_message)
             
             if auth_data['type'] == 'login':
                 username = auth_data['username']
                 password = auth_data['password']
-                print(f"用户尝试登录: {username}")
                 
                 # 验证用户
-                user = self.db.verify_user(username, password)
+                user = await self._verify_user(username, password)
                 if user:
-                    print(f"用户 {username} 验证成功")
+                    self.users.put(user)
                     user_info = {
                         'user_id': user['user_id'],  # 确保字段名称正确
                         'username': user['username'],
@@ -33,134 +720,283 @@ class ChatServer:
                     }
                     
                     # 发送登录成功响应
-                    await websocket.send(json.dumps({
+                    await websocket.send(reply(codec, auth_data, {
                         'type': 'auth',
                         'success': True,
                         'user_info': user_info
                     }))
                     
-                    # 存储客户端连接
-                    self.clients[user['user_id']] = websocket
-                    print(f"用户 {username} 已连接，ID: {user['user_id']}")
+                    # 存储客户端连接，之后发往该连接的帧都经过它的出站队列
+                    session = ClientSession(
+                        websocket,
+                        user,
+                        self.outbound_queue_size,
+                        self.slow_consumer_policy,
+                        codec
+                    )
+                    session.start()
+                    self.heartbeat.add(session)
+                    if self.clients.add(session):
+                        # 该用户在本进程的第一个设备上线，之后再查询离线消息
+                        await self.user_online(user['user_id'])
+                    log.info("用户已连接", username=username, user_id=user['user_id'],
+                             devices=len(self.clients.sessions_of(user['user_id'])), codec=codec.name)
+                    
+                    # 补发离线期间收到的消息，并告知当前在线的好友
+                    await self.send_pending_messages(session)
+                    await self.presence.send_snapshot(session)
                     
                     # 处理后续消息
+                    sink = ReplySink(session.send, codec)
                     async for message in websocket:
+                        session.last_seen = time.monotonic()
                         try:
-                            data = json.loads(message)
-                            print(f"收到消息: {message}")
-                            
-                            if data['type'] == 'get_friends':
-                                friends = self.db.get_friends(data['user_id'])
-                                print(f"发送好友列表: {friends}")
-                                await websocket.send(json.dumps({
-                                    'type': 'friends_list',
-                                    'friends': friends
-                                }))
-                                
-                            elif data['type'] == 'get_history':
-                                try:
-                                    friend_nickname = data['friend_nickname']
-                                    print(f"收到聊天记录请求: user_id={user['user_id']}, friend_nickname={friend_nickname}")  # 调试信息
-                                    
-                                    friend = self.db.get_user_by_nickname(friend_nickname)
-                                    print(f"查找到好友信息: {friend}")  # 调试信息
-                                    
-                                    if friend:
-                                        history = self.db.get_chat_history(user['user_id'], friend['user_id'])
-                                        print(f"获取到聊天记录: {history}")  # 调试信息
-                                        
-                                        await websocket.send(json.dumps({
-                                            'type': 'history',
-                                            'messages': history
-                                        }))
-                                        print("聊天记录已发送")  # 调试信息
-                                    else:
-                                        print(f"未找到好友: {friend_nickname}")
-                                        await websocket.send(json.dumps({
-                                            'type': 'history',
-                                            'messages': []
-                                        }))
-                                except Exception as e:
-                                    print(f"处理聊天记录请求失败: {e}")
-                                    await websocket.send(json.dumps({
-                                        'type': 'history',
-                                        'messages': []
-                                    }))
-                                    
-                            elif data['type'] == 'message':
-                                try:
-                                    to_nickname = data['to_nickname']
-                                    content = data['content']
-                                    message_type = data.get('message_type', 'text')
-                                    
-                                    to_user = self.db.get_user_by_nickname(to_nickname)
-                                    if to_user:
-                                        # 保存消息到数据库
-                                        self.db.save_message(
-                                            user['user_id'],
-                                            to_user['user_id'],
-                                            content,
-                                            message_type
-                                        )
-                                        
-                                        # 如果接收者在线，发送消息
-                                        if to_user['user_id'] in self.clients:
-                                            await self.clients[to_user['user_id']].send(json.dumps({
-                                                'type': 'message',
-                                                'from_id': user['user_id'],
-                                                'from_nickname': user['nickname'],
-                                                'content': content,
-                                                'message_type': message_type,
-                                                'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                            }))
-                                except Exception as e:
-                                    print(f"处理消息失败: {e}")
-                                    
-                        except json.JSONDecodeError:
-                            print("无效的JSON消息")
+                            data = codec.decode(message)
+                        except ValueError:
+                            data = None
+                        if not isinstance(data, dict):
+                            # 请求必须是对象，无法解码或不是对象时回复错误，连接继续可用
+                            log.warning("无效的消息", user_id=session.user_id, codec=codec.name)
+                            await sink.send({}, {'type': 'error', 'message': '无效的请求'})
+                            continue
+                        op = data.get('type')
+                        try:
+                            log.debug("收到请求", sample=op, user_id=session.user_id, op=op, request_id=data.get('id'))
+                            await self._dispatch(session, data, sink)
                         except Exception as e:
-                            print(f"处理消息错误: {e}")
+                            log.error("处理请求错误", user_id=session.user_id, op=op, error=str(e))
                             
                 else:
-                    print(f"用户 {username} 验证失败")
-                    await websocket.send(json.dumps({
+                    log.info("用户验证失败", username=username)
+                    await websocket.send(reply(codec, auth_data, {
                         'type': 'auth',
                         'success': False,
                         'message': '用户名或密码错误'
                     }))
+            else:
+                # 登录前只能调用不需要登录的请求，如注册
+                await self._dispatch(None, auth_data, ReplySink(websocket.send, codec))
                     
         except websockets.exceptions.ConnectionClosed:
-            print("客户端连接已关闭")
+            log.debug("客户端连接已关闭")
+        except asyncio.TimeoutError:
+            log.info("连接超时未发送请求，关闭连接", timeout=self.heartbeat.timeout)
         except Exception as e:
-            print(f"处理客户端错误: {e}")
+            log.error("处理客户端错误", error=str(e))
         finally:
+            self.connections -= 1
             # 清理客户端连接
-            for user_id, ws in list(self.clients.items()):
-                if ws == websocket:
-                    del self.clients[user_id]
-                    print(f"用户 {user_id} 已断开连接")
-                    break
-
-async def main():
-    server = ChatServer()
+            if session is not None:
+                self.heartbeat.remove(session)
+                if self.clients.remove(session):
+                    # 该用户在本进程的最后一个设备下线
+                    self.user_offline(session.user_id)
+                await session.close()
+                log.info("用户已断开连接", user_id=session.user_id)
+
+async def main(host="0.0.0.0", port=8795, worker_id=None, broker_path=None, metrics_port=METRICS_PORT,
+               server_options=None):
+    """运行聊天服务器，worker_id 不为空时作为多进程模式下的一个工作进程
+
+    metrics_port 不为 0 时在该端口提供 /metrics，多进程模式下每个工作进程使用 metrics_port + worker_id。
+    server_options 是传给 ChatServer 的关键字参数，见 server_options()。
+    """
+    server = ChatServer(**(server_options or {}))
+    server.writer.start()
+    server.heartbeat.start()
+    server.loop_lag.start()
+    metrics = None
+    if metrics_port:
+        metrics = MetricsServer(server.write_metrics, host, metrics_port + (worker_id or 0))
+        await metrics.start()
+    if worker_id is not None:
+        server.broker = BrokerClient(worker_id, server.handle_broker_event, broker_path)
+        await server.broker.connect()
     try:
         async with websockets.serve(
             server.handle_client,
-            "0.0.0.0",
-            8795,
+            host,
+            port,
             ping_interval=None,
-            max_size=None
+            max_size=MAX_FRAME_SIZE,
+            select_subprotocol=select_subprotocol,
+            reuse_port=worker_id is not None,  # 多个工作进程共用同一端口
+            **server.compression.server_options()
         ):
-            print("聊天服务器已启动，监听端口 8795...")
-            await asyncio.Future()
+            log.info("聊天服务器已启动", port=port, worker_id=worker_id)
+            # SIGTERM 和 Ctrl+C 一样走下面的清理流程，多进程模式下父进程用它通知工作进程退出
+            stop = asyncio.Event()
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+            await stop.wait()
     except Exception as e:
-        print(f"服务器启动失败: {e}")
+        log.error("聊天服务器启动失败", port=port, worker_id=worker_id, error=str(e))
         raise
+    finally:
+        if metrics is not None:
+            await metrics.stop()
+        await server.loop_lag.stop()
+        await server.heartbeat.stop()
+        await server.writer.stop()
+        if server.broker is not None:
+            await server.broker.close()
+        if server._password_upgrades:
+            await asyncio.gather(*server._password_upgrades, return_exceptions=True)
+        server.passwords.close()
+        server.db.close()
+        log.info("压缩统计", **server.compression.stats.as_dict())
+
+def run_worker(worker_id, host, port, broker_path, metrics_port, server_options):
+    """工作进程入口"""
+    # 终端的 Ctrl+C 会发给整个进程组，由父进程统一用 SIGTERM 通知子进程，避免重复收到信号；
+    # fork 继承了父进程的信号处理函数，SIGTERM 先恢复默认，启动后再由 main() 接管
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    setup_logging()  # fork 出的子进程需要自己的日志线程
+    try:
+        asyncio.run(main(host, port, worker_id, broker_path, metrics_port, server_options))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutdown_logging()
+
+def run_workers(workers, host, port, broker_path=BROKER_PATH, metrics_port=METRICS_PORT, server_options=None):
+    """启动中转进程和 workers 个工作进程，工作进程通过 SO_REUSEPORT 共用端口
+
+    父进程收到 SIGTERM 或 SIGINT 时同时通知所有子进程退出，再在同一个期限内等待它们。
+    """
+    broker = multiprocessing.Process(target=run_broker, args=(broker_path,), name='broker')
+    alive = [multiprocessing.Process(
+        target=run_worker,
+        args=(worker_id, host, port, broker_path, metrics_port, server_options),
+        name=f'worker-{worker_id}'
+    ) for worker_id in range(workers)]
+    processes = [broker] + alive
+    stopping = None  # 收到的退出信号
+
+    def on_signal(signum, frame):
+        # 信号处理函数中不写日志，日志队列的锁可能正被主线程持有
+        nonlocal stopping
+        if stopping is None:
+            stopping = signal.Signals(signum)
+            _stop_processes(processes[1:])  # 中转进程在工作进程退出后再关闭
+
+    # 在启动子进程前安装，子进程在入口处重新设置自己的处理方式
+    previous = {signum: signal.signal(signum, on_signal) for signum in (signal.SIGTERM, signal.SIGINT)}
+    try:
+        for process in processes:
+            process.start()
+        while alive and stopping is None:
+            ready = wait([broker.sentinel] + [process.sentinel for process in alive])
+            if stopping is not None:
+                log.info("收到退出信号，关闭所有子进程", signal=stopping.name)
+                break
+            if broker.sentinel in ready:
+                # 没有中转进程时工作进程无法转发消息和登记上线，全部关闭
+                broker.join()
+                log.error("中转进程已退出，关闭所有工作进程", exitcode=broker.exitcode)
+                break
+            for process in alive:
+                if process.sentinel in ready:
+                    process.join()
+                    log.error("工作进程已退出", name=process.name, exitcode=process.exitcode)
+            alive = [process for process in alive if process.sentinel not in ready]
+    finally:
+        # 先让工作进程退出并等待，中转进程最后退出，整体最多等待 WORKER_SHUTDOWN_TIMEOUT
+        deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+        _stop_processes(processes[1:])
+        _join_processes(processes[1:], deadline)
+        _stop_processes([broker])
+        _join_processes([broker], deadline)
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+def _stop_processes(processes):
+    """向仍在运行的子进程发送 SIGTERM，子进程收到后执行正常的清理流程"""
+    for process in processes:
+        if process.pid is not None and process.exitcode is None:
+            process.terminate()
+
+def _join_processes(processes, deadline):
+    """等待子进程退出，超过 deadline 仍未退出的强制结束"""
+    for process in processes:
+        if process.pid is None:
+            continue
+        process.join(max(0, deadline - time.monotonic()))
+        if process.is_alive():
+            log.warning("子进程未能按时退出，强制结束", name=process.name)
+            process.kill()
+            process.join()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='SapphireKey 聊天服务器')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8795)
+    parser.add_argument('--workers', type=int, default=1, help='工作进程数，大于 1 时启用多进程模式')
+    parser.add_argument('--broker-path', default=BROKER_PATH, help='中转进程的 Unix socket 路径')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT, help='/metrics 端口，0 表示不启用')
+    parser.add_argument('--log-level', default=LOG_LEVEL, help='日志级别，如 DEBUG、INFO、WARNING')
+    parser.add_argument('--log-format', default='text', choices=['text', 'json'])
+    parser.add_argument('--log-sample', action='append', metavar='OP=RATE',
+                        help='调试日志按请求类型采样，如 get_history=0.01，可重复指定')
+    parser.add_argument('--outbound-queue-size', type=int, default=OUTBOUND_QUEUE_SIZE,
+                        help='每个连接出站队列的长度')
+    parser.add_argument('--slow-consumer-policy', default=POLICY_SPILL, choices=POLICIES,
+                        help='出站队列满时的处理策略：丢弃、断开连接或留给离线消息补发')
+    parser.add_argument('--heartbeat-interval', type=float, default=HEARTBEAT_INTERVAL,
+                        help='连接空闲多久后发送 ping（秒）')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='连接多久没有收到任何帧后关闭（秒），也是登录前等待第一帧的时间')
+    parser.add_argument('--compression', action=argparse.BooleanOptionalAction, default=COMPRESSION_ENABLED,
+                        help='是否协商 permessage-deflate 压缩')
+    parser.add_argument('--compression-window-bits', type=int, default=WINDOW_BITS,
+                        help='压缩窗口大小（9-15），越大压缩率越高、每个连接占用内存越多')
+    parser.add_argument('--compression-mem-level', type=int, default=MEMORY_LEVEL, help='zlib memLevel（1-9）')
+    parser.add_argument('--compression-min-size', type=int, default=MIN_COMPRESS_SIZE,
+                        help='小于该字节数的帧不压缩')
+    args = parser.parse_args()
+    if args.outbound_queue_size < 1:
+        parser.error('--outbound-queue-size 必须大于 0')
+    if args.idle_timeout <= args.heartbeat_interval:
+        parser.error('--idle-timeout 必须大于 --heartbeat-interval')
+    try:
+        compression_policy(args)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+def compression_policy(args):
+    """从命令行参数生成压缩配置"""
+    return CompressionPolicy(
+        args.compression,
+        args.compression_window_bits,
+        args.compression_mem_level,
+        args.compression_min_size
+    )
+
+def server_options(args):
+    """从命令行参数生成 ChatServer 的关键字参数"""
+    return {
+        'outbound_queue_size': args.outbound_queue_size,
+        'slow_consumer_policy': args.slow_consumer_policy,
+        'heartbeat_interval': args.heartbeat_interval,
+        'idle_timeout': args.idle_timeout,
+        'compression': compression_policy(args),
+    }
 
 if __name__ == "__main__":
+    args = parse_args()
+    setup_logging(args.log_level, parse_sample(args.log_sample), args.log_format)
     try:
-        asyncio.run(main())
+        if args.workers > 1:
+            run_workers(args.workers, args.host, args.port, args.broker_path, args.metrics_port,
+                        server_options(args))
+        else:
+            asyncio.run(main(args.host, args.port, metrics_port=args.metrics_port,
+                             server_options=server_options(args)))
     except KeyboardInterrupt:
-        print("\n服务器已关闭")
+        pass
     except Exception as e:
-        print(f"服务器运行错误: {e}")
\ No newline at end of file
+        log.error("服务器运行错误", error=str(e))
+    finally:
+        log.info("服务器已关闭")
+        shutdown_logging()
@@ -0,0 +1,189 @@
+import asyncio
+import time
+import websockets
+from codec import JSON
+from log import get_logger
+
+# 出站队列满时对非临时消息的处理策略
+POLICY_DROP = 'drop'  # 丢弃该消息
+POLICY_DISCONNECT = 'disconnect'  # 断开该慢速连接
+POLICY_SPILL = 'spill'  # 不推送，留给离线消息补发
+POLICIES = (POLICY_DROP, POLICY_DISCONNECT, POLICY_SPILL)
+
+OUTBOUND_QUEUE_SIZE = 256  # 每个连接出站队列的默认长度
+
+log = get_logger('session')
+
+_disconnects = set()  # 正在断开慢速连接的任务，保持引用直到完成，避免被垃圾回收
+
+
+class ClientSession:
+    """一个已登录的客户端连接
+
+    所有发往该连接的帧都先进入一个有界队列，由连接自己的写任务按顺序发送。
+    其他连接推送消息时使用不阻塞的 offer()，接收方网络慢或卡住只会让它自己的队列变满，
+    不会阻塞发送方的读循环。
+    """
+
+    def __init__(self, websocket, user, max_queue=OUTBOUND_QUEUE_SIZE, policy=POLICY_SPILL, codec=JSON):
+        if policy not in POLICIES:
+            raise ValueError(f"未知的慢速连接策略: {policy}")
+        self.websocket = websocket
+        self.user = user
+        self.user_id = user['user_id']
+        self.policy = policy
+        self.codec = codec  # 握手时协商的编解码器，入队的帧都已按它编码
+        self._queue = asyncio.Queue(max_queue)
+        self._writer = None
+        self.closed = False
+        self.last_seen = time.monotonic()  # 最近一次收到该连接的帧的时间
+
+        # 统计信息
+        self.sent = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self):
+        """出站队列中等待发送的帧数"""
+        return self._queue.qsize()
+
+    def start(self):
+        """启动写任务"""
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write_loop())
+
+    async def send(self, frame, on_sent=None):
+        """发送对本连接请求的响应，队列满时等待
+
+        on_sent 不为空时，在帧写入连接后调用。
+        """
+        if self.closed:
+            return
+        await self._queue.put((frame, on_sent))
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+
+    def offer(self, frame, ephemeral=False, on_sent=None):
+        """不阻塞地推送一帧，返回是否已进入队列
+
+        ephemeral 表示可以丢弃的临时事件（如在线状态），队列满时直接丢弃；
+        其他帧按 policy 处理。返回 False 时消息没有推送给该连接。
+        on_sent 不为空时，在帧写入连接后调用。
+        """
+        if self.closed:
+            return False
+        try:
+            self._queue.put_nowait((frame, on_sent))
+        except asyncio.QueueFull:
+            if ephemeral or self.policy == POLICY_DROP:
+                self.dropped += 1
+            elif self.policy == POLICY_SPILL:
+                self.spilled += 1
+            else:
+                self.dropped += 1
+                log.warning("出站队列已满，断开连接", user_id=self.user_id)
+                task = asyncio.create_task(self._disconnect(1008, 'slow consumer'))
+                _disconnects.add(task)
+                task.add_done_callback(_disconnects.discard)
+                self.closed = True
+            return False
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    async def _write_loop(self):
+        """按顺序把队列中的帧写到连接上"""
+        try:
+            while True:
+                frame, on_sent = await self._queue.get()
+                await self.websocket.send(frame)
+                self.sent += 1
+                if on_sent is not None:
+                    on_sent()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.closed = True
+            # 清空队列，唤醒可能还在 send() 中等待的协程
+            while not self._queue.empty():
+                self._queue.get_nowait()
+
+    async def _disconnect(self, code, reason):
+        """关闭 WebSocket 连接，连接的读循环结束后会注销该连接"""
+        try:
+            await self.websocket.close(code, reason)
+        except Exception as e:
+            log.warning("关闭连接失败", user_id=self.user_id, error=str(e))
+
+    async def close(self):
+        """停止写任务，未发送的帧被丢弃"""
+        self.closed = True
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+
+    def stats(self):
+        """返回该连接出站队列的统计信息"""
+        return {
+            'user_id': self.user_id,
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+        }
+
+
+class SessionRegistry:
+    """在线连接登记表
+
+    同一用户可以在多台设备上同时登录，每个用户对应一组连接。
+    登记和注销都是常数时间，断开连接时不需要遍历所有连接。
+    """
+
+    def __init__(self):
+        self._by_user = {}  # user_id -> 该用户的 ClientSession 集合
+        self._users = {}  # ClientSession -> user_id
+
+    def __len__(self):
+        """在线连接数"""
+        return len(self._users)
+
+    def __iter__(self):
+        """遍历所有在线连接"""
+        return iter(list(self._users))
+
+    def add(self, session):
+        """登记连接，返回是否是该用户的第一个连接"""
+        self._users[session] = session.user_id
+        sessions = self._by_user.setdefault(session.user_id, set())
+        sessions.add(session)
+        return len(sessions) == 1
+
+    def remove(self, session):
+        """注销连接，返回该用户是否已没有在线连接"""
+        user_id = self._users.pop(session, None)
+        if user_id is None:
+            return False
+        sessions = self._by_user[user_id]
+        sessions.discard(session)
+        if sessions:
+            return False
+        del self._by_user[user_id]
+        return True
+
+    def sessions_of(self, user_id):
+        """返回用户所有在线连接"""
+        return list(self._by_user.get(user_id, ()))
+
+    def is_online(self, user_id):
+        """用户是否有在线连接"""
+        return user_id in self._by_user
+
+    def user_count(self):
+        """在线用户数"""
+        return len(self._by_user)
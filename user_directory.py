@@ -0,0 +1,111 @@
+from collections import OrderedDict
+
+
+class UserDirectory:
+    """进程内的用户信息缓存
+
+    按 user_id 做 LRU 淘汰，同时维护昵称和用户名到 user_id 的索引，
+    消息转发和聊天记录请求按昵称查用户时不再每次访问数据库。
+    注册新用户或修改用户资料后需要调用 invalidate()。
+    """
+
+    def __init__(self, db, capacity=10000):
+        self.db = db  # AsyncDatabase
+        self.capacity = capacity
+        self._users = OrderedDict()  # user_id -> 用户信息
+        self._by_nickname = {}  # nickname -> user_id
+        self._by_username = {}  # username -> user_id
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._users)
+
+    def put(self, user):
+        """写入或更新一个用户"""
+        if not user:
+            return
+        user_id = user['user_id']
+        old = self._users.pop(user_id, None)
+        if old:
+            self._drop_indexes(old)
+        self._users[user_id] = user
+        self._by_nickname[user['nickname']] = user_id
+        self._by_username[user['username']] = user_id
+
+        while len(self._users) > self.capacity:
+            _, evicted = self._users.popitem(last=False)
+            self._drop_indexes(evicted)
+            self.evictions += 1
+
+    def invalidate(self, user_id=None, nickname=None, username=None):
+        """删除指定用户的缓存，可以按 user_id、昵称或用户名指定"""
+        if user_id is None and nickname is not None:
+            user_id = self._by_nickname.pop(nickname, None)
+        if user_id is None and username is not None:
+            user_id = self._by_username.pop(username, None)
+        user = self._users.pop(user_id, None)
+        if user:
+            self._drop_indexes(user)
+
+    def clear(self):
+        """清空缓存"""
+        self._users.clear()
+        self._by_nickname.clear()
+        self._by_username.clear()
+
+    def _drop_indexes(self, user):
+        """删除指向该用户的昵称和用户名索引"""
+        if self._by_nickname.get(user['nickname']) == user['user_id']:
+            del self._by_nickname[user['nickname']]
+        if self._by_username.get(user['username']) == user['user_id']:
+            del self._by_username[user['username']]
+
+    def _lookup(self, user_id):
+        """从缓存中取用户并更新 LRU 顺序"""
+        user = self._users.get(user_id)
+        if user is None:
+            self.misses += 1
+            return None
+        self._users.move_to_end(user_id)
+        self.hits += 1
+        return user
+
+    async def get_by_id(self, user_id):
+        """通过ID获取用户信息"""
+        user = self._lookup(user_id)
+        if user is None:
+            user = await self.db.get_user_by_id(user_id)
+            self.put(user)
+        return user
+
+    async def get_by_nickname(self, nickname):
+        """通过昵称获取用户信息"""
+        user = self._lookup(self._by_nickname.get(nickname))
+        if user is None:
+            user = await self.db.get_user_by_nickname(nickname)
+            self.put(user)
+        return user
+
+    async def get_by_username(self, username):
+        """通过用户名获取用户信息"""
+        user = self._lookup(self._by_username.get(username))
+        if user is None:
+            user = await self.db.get_user_by_username(username)
+            self.put(user)
+        return user
+
+    def stats(self):
+        """返回缓存的统计信息"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._users),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+        }